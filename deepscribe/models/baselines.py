@@ -8,6 +8,7 @@ import wandb
 from wandb.keras import WandbCallback
 import os
 from sklearn.utils.class_weight import compute_class_weight
+from .datasets import uses_tf_data, training_dataset, validation_dataset, StepsPerSecond
 
 
 def cnn_classifier_2conv(
@@ -15,9 +16,12 @@ def cnn_classifier_2conv(
 ) -> Tuple[kr.callbacks.History, kr.models.Model]:
     """
 
-    :param x_train: training image data, with shape [n_images, x_dim, y_dim, n_channels]
+    :param x_train: training image data, with shape
+    [n_images, x_dim, y_dim, n_channels], or with the tf.data input pipeline, a
+    tf.data.Dataset of (image, label) pairs
     :param y_train: categorical variables with shape [n_images,]
-    :param x_val: validation image data, with shape [n_images, x_dim, y_dim, n_channels]
+    :param x_val: validation image data, with shape
+    [n_images, x_dim, y_dim, n_channels], or a tf.data.Dataset
     :param y_val: categorical variables with shape [n_images,]
     :param model: tf.Keras model.
     :param params: parameter dictionary.
@@ -89,6 +93,7 @@ def cnn_classifier_2conv(
 
     wandb.init(project="deepscribe", config=params)
 
+    callbacks.insert(0, StepsPerSecond())
     callbacks.append(WandbCallback())
 
     if "reweight" in params:
@@ -99,6 +104,20 @@ def cnn_classifier_2conv(
     else:
         class_weight_dict = None
 
+    if uses_tf_data(params):
+        train_data, steps_per_epoch = training_dataset(x_train, y_train, params)
+
+        history = model.fit(
+            train_data,
+            steps_per_epoch=steps_per_epoch,
+            epochs=params["epochs"],
+            validation_data=validation_dataset(x_val, y_val, params),
+            callbacks=callbacks,
+            class_weight=class_weight_dict,
+        )
+
+        return history, model
+
     # use image data generator to perform random translations
 
     shear_range = params.get("shear", 0.0)
@@ -1,34 +1,62 @@
 import tensorflow.keras as kr
 import tensorflow as tf
 import numpy as np
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 import wandb
 from wandb.keras import WandbCallback
 import os
 from sklearn.utils.class_weight import compute_class_weight
 from abc import ABC
 from .parametermodel import ParameterModel
+from .datasets import (
+    uses_tf_data,
+    training_dataset,
+    validation_dataset,
+    cached_features,
+    StepsPerSecond,
+)
+
+
+def grayscale_stem(params: Dict) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+
+    Single-channel input for the architectures expecting RGB images, expanded to three
+    channels inside the graph. The channel is repeated, or with "rgb_stem": "learned" in
+    the parameters, mapped to three channels by a 1x1 convolution trained with the rest
+    of the model.
+
+    :param params: parameter dictionary.
+    :return: input tensor, [n_images, x_dim, y_dim, 1], and the three-channel tensor to
+    feed the base model
+    """
+    inputs = kr.Input(shape=(None, None, 1))
+
+    if params.get("rgb_stem", "repeat") == "learned":
+        rgb = kr.layers.Conv2D(3, kernel_size=(1, 1), name="rgb_stem")(inputs)
+    else:
+        rgb = kr.layers.Concatenate(name="rgb_stem")([inputs, inputs, inputs])
+
+    return inputs, rgb
 
 
 class CNNAugment(ParameterModel, ABC):
     """
 
-    Subclass of ParameterModel that trains a CNN image classification network with a data augmentation routine.
+    Subclass of ParameterModel that trains a CNN image classification network with a
+    data augmentation routine. With "input_pipeline": "tf.data" in the parameters, the
+    training data may also be a tf.data.Dataset of (image, label) pairs, see
+    datasets.training_dataset.
 
     """
 
-    def _train_model(
-        self,
-        x_train: np.array,
-        y_train: np.array,
-        x_val: np.array,
-        y_val: np.array,
-        model: kr.Model,
-        params: Dict,
-    ) -> kr.callbacks.History:
+    def _callbacks(self, params: Dict) -> List[kr.callbacks.Callback]:
+        """
 
-        if "seed" in params:
-            tf.random.set_seed(params["seed"])
+        Sets up logging to wandb and the training callbacks.
+
+        :param params: parameter dictionary.
+        :return: list of callbacks
+        """
 
         callbacks = (
             [
@@ -45,15 +73,54 @@ class CNNAugment(ParameterModel, ABC):
 
         wandb.init(project="deepscribe", config=params)
 
+        callbacks.insert(0, StepsPerSecond())
         callbacks.append(WandbCallback())
 
-        if "reweight" in params:
-            class_weights_arr = compute_class_weight(
-                "balanced", np.unique(y_train), y_train
+        return callbacks
+
+    def _class_weights(self, y_train: np.array, params: Dict) -> Optional[Dict]:
+        """
+
+        :param y_train: categorical variables with shape [n_images,]
+        :param params: parameter dictionary.
+        :return: dict mapping classes to balanced weights if reweighting, else None
+        """
+
+        if "reweight" not in params:
+            return None
+
+        class_weights_arr = compute_class_weight(
+            "balanced", np.unique(y_train), y_train
+        )
+        return dict(enumerate(class_weights_arr))
+
+    def _train_model(
+        self,
+        x_train: np.array,
+        y_train: np.array,
+        x_val: np.array,
+        y_val: np.array,
+        model: kr.Model,
+        params: Dict,
+    ) -> kr.callbacks.History:
+
+        if "seed" in params:
+            tf.random.set_seed(params["seed"])
+
+        callbacks = self._callbacks(params)
+        class_weight_dict = self._class_weights(y_train, params)
+
+        if uses_tf_data(params):
+            train_data, steps_per_epoch = training_dataset(x_train, y_train, params)
+
+            return model.fit(
+                train_data,
+                steps_per_epoch=steps_per_epoch,
+                epochs=params["epochs"],
+                validation_data=validation_dataset(x_val, y_val, params),
+                callbacks=callbacks,
+                class_weight=class_weight_dict,
             )
-            class_weight_dict = dict(enumerate(class_weights_arr))
-        else:
-            class_weight_dict = None
 
         # use image data generator to perform random translations
 
@@ -134,25 +201,110 @@ class CNN2Conv(CNNAugment):
         return model
 
 
-class VGG16(CNNAugment):
+class TransferCNN(CNNAugment, ABC):
     """
 
-    Subclass of CNNAugment that transfers learned weights from VGG16.
+    Subclass of CNNAugment for the architectures transferring a base model from
+    kr.applications, with a dense head on its pooled features. With "transfer" and
+    "cache_features" both set, the frozen base model computes the features of each image
+    once per dataset, cached in the "feature_cache" folder under the "feature_stamp" of
+    the dataset, and only the head is trained on them. The images are not augmented in
+    this mode.
+
+    """
+
+    def __call__(
+        self,
+        x_train: np.array,
+        y_train: np.array,
+        x_val: np.array,
+        y_val: np.array,
+        params: Dict,
+    ) -> Tuple[kr.callbacks.History, kr.models.Model]:
+
+        if not (params.get("transfer", False) and params.get("cache_features", False)):
+            return super().__call__(x_train, y_train, x_val, y_val, params)
+
+        if params.get("rgb_stem", "repeat") == "learned":
+            raise ValueError(
+                "The learned RGB stem is trained with the model, so the features of a "
+                "transferred base model can't be cached with it."
+            )
+
+        if "seed" in params:
+            tf.random.set_seed(params["seed"])
+
+        model = self._build_model(params)
+        pooled = model.get_layer("pooled_features")
+        backbone = kr.Model(inputs=model.input, outputs=pooled.output)
+
+        features_train, features_val = [
+            cached_features(
+                backbone,
+                images,
+                labels,
+                os.path.join(
+                    params["feature_cache"], f"{type(self).__name__}_{split}.npy"
+                ),
+                params["batch_size"],
+                params.get("feature_stamp", ""),
+            )
+            for split, images, labels in [
+                ("train", x_train, y_train),
+                ("valid", x_val, y_val),
+            ]
+        ]
+
+        # the head shares its layers with the model, so the trained model still takes
+        # images
+        feature_input = kr.Input(shape=(backbone.output_shape[-1],))
+        x = feature_input
+
+        for layer in model.layers[model.layers.index(pooled) + 1 :]:
+            x = layer(x)
+
+        head = kr.Model(inputs=feature_input, outputs=x)
+        head.compile(
+            optimizer=params["optimizer"],
+            loss="sparse_categorical_crossentropy",
+            metrics=["acc", kr.metrics.TopKCategoricalAccuracy(k=params.get("k", 3))],
+        )
+
+        history = head.fit(
+            features_train,
+            y_train,
+            batch_size=params["batch_size"],
+            epochs=params["epochs"],
+            validation_data=(features_val, y_val),
+            callbacks=self._callbacks(params),
+            class_weight=self._class_weights(y_train, params),
+        )
+
+        return history, model
+
+
+class VGG16(TransferCNN):
+    """
+
+    Subclass of TransferCNN that transfers learned weights from VGG16.
 
     """
 
     def _build_model(self, params: Dict) -> kr.Model:
 
+        inputs, rgb = grayscale_stem(params)
+
         base_model = kr.applications.vgg16.VGG16(
             weights="imagenet" if params.get("transfer", False) else None,
             include_top=False,
+            input_shape=(None, None, 3),
         )
 
-        x = base_model.output
+        x = base_model(rgb)
 
         # TODO: freeze dynamic number of layers based on config file
 
-        x = kr.layers.GlobalAveragePooling2D()(x)
+        x = kr.layers.GlobalAveragePooling2D(name="pooled_features")(x)
         # let's add a fully-connected layer
 
         x = kr.layers.Dropout(params["dropout"])(x)
@@ -167,7 +319,7 @@ class VGG16(CNNAugment):
 
         # TODO: set learning rate
 
-        model = kr.Model(inputs=base_model.input, outputs=predictions)
+        model = kr.Model(inputs=inputs, outputs=predictions)
 
         model.compile(
             optimizer=params["optimizer"],
@@ -178,25 +330,28 @@ class VGG16(CNNAugment):
         return model
 
 
-class VGG19(CNNAugment):
+class VGG19(TransferCNN):
     """
 
-        Subclass of CNNAugment that transfers learned weights from VGG19.
+        Subclass of TransferCNN that transfers learned weights from VGG19.
 
         """
 
     def _build_model(self, params: Dict) -> kr.Model:
 
+        inputs, rgb = grayscale_stem(params)
+
         base_model = kr.applications.vgg19.VGG19(
             weights="imagenet" if params.get("transfer", False) else None,
             include_top=False,
+            input_shape=(None, None, 3),
         )
 
-        x = base_model.output
+        x = base_model(rgb)
 
         # TODO: freeze dynamic number of layers based on config file
 
-        x = kr.layers.GlobalAveragePooling2D()(x)
+        x = kr.layers.GlobalAveragePooling2D(name="pooled_features")(x)
         # let's add a fully-connected layer
 
         x = kr.layers.Dropout(params["dropout"])(x)
@@ -215,7 +370,7 @@ class VGG19(CNNAugment):
 
         # TODO: set learning rate
 
-        model = kr.Model(inputs=base_model.input, outputs=predictions)
+        model = kr.Model(inputs=inputs, outputs=predictions)
 
         model.compile(
             optimizer=params["optimizer"],
@@ -226,24 +381,27 @@ class VGG19(CNNAugment):
         return model
 
 
-class ResNet50(CNNAugment):
+class ResNet50(TransferCNN):
     """
-    Subclass of CNNAugment using architecture from ResNet50
+    Subclass of TransferCNN using architecture from ResNet50
 
     """
 
     def _build_model(self, params: Dict) -> kr.Model:
 
+        inputs, rgb = grayscale_stem(params)
+
         base_model = kr.applications.resnet50.ResNet50(
             weights="imagenet" if params.get("transfer", False) else None,
             include_top=False,
+            input_shape=(None, None, 3),
         )
 
-        x = base_model.output
+        x = base_model(rgb)
 
         # TODO: freeze dynamic number of layers based on config file
 
-        x = kr.layers.GlobalAveragePooling2D()(x)
+        x = kr.layers.GlobalAveragePooling2D(name="pooled_features")(x)
         # let's add a fully-connected layer
 
         x = kr.layers.Dropout(params["dropout"])(x)
@@ -262,7 +420,7 @@ class ResNet50(CNNAugment):
 
         # TODO: set learning rate
 
-        model = kr.Model(inputs=base_model.input, outputs=predictions)
+        model = kr.Model(inputs=inputs, outputs=predictions)
 
         model.compile(
             optimizer=params["optimizer"],
@@ -273,24 +431,27 @@ class ResNet50(CNNAugment):
         return model
 
 
-class ResNet50V2(CNNAugment):
+class ResNet50V2(TransferCNN):
     """
-    Subclass of CNNAugment using architecture from ResNet50
+    Subclass of TransferCNN using architecture from ResNet50
 
     """
 
     def _build_model(self, params: Dict) -> kr.Model:
 
+        inputs, rgb = grayscale_stem(params)
+
         base_model = kr.applications.resnet_v2.ResNet50V2(
             weights="imagenet" if params.get("transfer", False) else None,
             include_top=False,
+            input_shape=(None, None, 3),
         )
 
-        x = base_model.output
+        x = base_model(rgb)
 
         # TODO: freeze dynamic number of layers based on config file
 
-        x = kr.layers.GlobalAveragePooling2D()(x)
+        x = kr.layers.GlobalAveragePooling2D(name="pooled_features")(x)
         # let's add a fully-connected layer
 
         x = kr.layers.Dropout(params["dropout"])(x)
@@ -309,7 +470,7 @@ class ResNet50V2(CNNAugment):
 
         # TODO: set learning rate
 
-        model = kr.Model(inputs=base_model.input, outputs=predictions)
+        model = kr.Model(inputs=inputs, outputs=predictions)
 
         model.compile(
             optimizer=params["optimizer"],
@@ -0,0 +1,283 @@
+# tf.data input pipelines for training, an alternative to ImageDataGenerator.flow
+#
+# Selected with "input_pipeline": "tf.data" in the model definition. Batches are
+# shuffled, augmented with random shear and zoom as graph ops on whole batches in
+# parallel, and prefetched while the model trains. The random transforms are drawn with
+# stateless ops seeded by the batch number, so a run is reproducible regardless of the
+# number of parallel calls.
+#
+# cached_features stores the outputs of a frozen backbone once per dataset, so transfer
+# models can train their head on the features alone.
+
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as kr
+from typing import Dict, Tuple, Union
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def uses_tf_data(params: Dict) -> bool:
+    """
+
+    :param params: parameter dictionary.
+    :return: whether the model definition selects the tf.data input pipeline
+    """
+    return params.get("input_pipeline", "generator") == "tf.data"
+
+
+def random_shear_zoom(
+    images: tf.Tensor, shear_range: float, zoom_range: float, seed: tf.Tensor
+) -> tf.Tensor:
+    """
+
+    Randomly shears and zooms a batch of images, with the transform of
+    ImageDataGenerator: a shear angle in degrees drawn from [-shear_range, shear_range]
+    and zoom factors for each axis drawn from [1 - zoom_range, 1 + zoom_range],
+    interpolating bilinearly and repeating the edge pixels.
+
+    :param images: batch of images, [n_images, x_dim, y_dim, n_channels]
+    :param shear_range: shear intensity in degrees
+    :param zoom_range: zoom intensity
+    :param seed: seed of the stateless random ops, int tensor of shape [2]
+    :return: batch of transformed images, same shape
+    """
+    shape = tf.shape(images)
+    n_images, height, width = shape[0], shape[1], shape[2]
+
+    uniform = tf.random.stateless_uniform([n_images, 3], seed)
+    shear = (2.0 * uniform[:, 0] - 1.0) * shear_range * np.pi / 180.0
+    zoom_rows = 1.0 - zoom_range + 2.0 * zoom_range * uniform[:, 1]
+    zoom_cols = 1.0 - zoom_range + 2.0 * zoom_range * uniform[:, 2]
+
+    # ImageDataGenerator transforms about this point, rather than the center of the
+    # image
+    center_row = tf.cast(height, tf.float32) / 2.0 + 0.5
+    center_col = tf.cast(width, tf.float32) / 2.0 + 0.5
+
+    rows, cols = tf.meshgrid(
+        tf.range(height, dtype=tf.float32) - center_row,
+        tf.range(width, dtype=tf.float32) - center_col,
+        indexing="ij",
+    )
+
+    # coordinates in the input image of each output pixel, [n_images, x_dim, y_dim]
+    shear, zoom_rows, zoom_cols = [
+        tf.reshape(param, [-1, 1, 1]) for param in [shear, zoom_rows, zoom_cols]
+    ]
+    in_rows = zoom_rows * rows - tf.sin(shear) * zoom_cols * cols + center_row
+    in_cols = tf.cos(shear) * zoom_cols * cols + center_col
+
+    row0 = tf.floor(in_rows)
+    col0 = tf.floor(in_cols)
+    row_weight = (in_rows - row0)[..., tf.newaxis]
+    col_weight = (in_cols - col0)[..., tf.newaxis]
+
+    flat = tf.reshape(images, [n_images, height * width, -1])
+
+    def gather(row, col):
+        row = tf.clip_by_value(tf.cast(row, tf.int32), 0, height - 1)
+        col = tf.clip_by_value(tf.cast(col, tf.int32), 0, width - 1)
+        pixels = tf.gather(
+            flat, tf.reshape(row * width + col, [n_images, -1]), batch_dims=1
+        )
+        return tf.reshape(pixels, shape)
+
+    top = (1.0 - col_weight) * gather(row0, col0) + col_weight * gather(row0, col0 + 1)
+    bottom = (1.0 - col_weight) * gather(row0 + 1, col0) + col_weight * gather(
+        row0 + 1, col0 + 1
+    )
+
+    return (1.0 - row_weight) * top + row_weight * bottom
+
+
+def training_dataset(
+    x_train: Union[np.ndarray, tf.data.Dataset], y_train: np.ndarray, params: Dict
+) -> Tuple[tf.data.Dataset, int]:
+    """
+
+    Builds the shuffled, augmented and batched training input. Repeats indefinitely, so
+    the random transforms differ between epochs.
+
+    :param x_train: training image data, with shape
+    [n_images, x_dim, y_dim, n_channels], or a tf.data.Dataset of (image, label) pairs,
+    e.g. from records.records_dataset
+    :param y_train: categorical variables with shape [n_images,]
+    :param params: parameter dictionary, using batch_size, shear, zoom, seed, and
+    optionally shuffle_buffer, the number of images shuffled at once (10000 by default),
+    and cache, a file to cache a streamed dataset in, or true to cache it in memory.
+    Streamed datasets aren't cached by default, so they never have to fit in memory.
+    :return: tf.data.Dataset of batches, number of batches per epoch
+    """
+    seed = params.get("seed", 0)
+
+    if isinstance(x_train, tf.data.Dataset):
+        dataset = x_train
+        cache = params.get("cache", False)
+
+        if cache:
+            dataset = dataset.cache(cache if isinstance(cache, str) else "")
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
+
+    # the buffer holds copies of the images. Selections are stored in shuffled order, so
+    # a bounded buffer still mixes the classes.
+    buffer_size = max(1, min(len(y_train), params.get("shuffle_buffer", 10000)))
+
+    dataset = (
+        dataset.shuffle(buffer_size, seed=seed, reshuffle_each_iteration=True)
+        .repeat()
+        .batch(params["batch_size"])
+    )
+
+    shear_range = params.get("shear", 0.0)
+    zoom_range = params.get("zoom", 0.0)
+
+    if shear_range or zoom_range:
+        dataset = dataset.enumerate().map(
+            lambda step, batch: (
+                random_shear_zoom(
+                    batch[0],
+                    shear_range,
+                    zoom_range,
+                    tf.stack([tf.constant(seed, tf.int64), step]),
+                ),
+                batch[1],
+            ),
+            num_parallel_calls=AUTOTUNE,
+        )
+
+    return (
+        dataset.prefetch(AUTOTUNE),
+        int(np.ceil(len(y_train) / params["batch_size"])),
+    )
+
+
+def validation_dataset(
+    x_val: Union[np.ndarray, tf.data.Dataset], y_val: np.ndarray, params: Dict
+) -> tf.data.Dataset:
+    """
+
+    Builds the batched validation input.
+
+    :param x_val: validation image data, with shape
+    [n_images, x_dim, y_dim, n_channels], or a tf.data.Dataset of (image, label) pairs
+    :param y_val: categorical variables with shape [n_images,]
+    :param params: parameter dictionary, using batch_size and cache, see
+    training_dataset
+    :return: tf.data.Dataset of batches
+    """
+    if isinstance(x_val, tf.data.Dataset):
+        dataset = x_val
+        # the cache file given for the training set is only used by the training set
+        if params.get("cache", False) is True:
+            dataset = dataset.cache()
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((x_val, y_val))
+
+    return dataset.batch(params["batch_size"]).prefetch(AUTOTUNE)
+
+
+class StepsPerSecond(kr.callbacks.Callback):
+    """
+
+    Logs the number of training steps per second of each epoch as steps_per_sec, to
+    compare input pipelines. Has to come before the callbacks reporting the logs.
+
+    """
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        # the validation at the end of the epoch is left out
+        self.last_step = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None and self.steps:
+            logs["steps_per_sec"] = self.steps / (self.last_step - self.epoch_start)
+
+
+def cached_features(
+    backbone: kr.Model,
+    images: Union[np.ndarray, tf.data.Dataset],
+    labels: np.ndarray,
+    path: str,
+    batch_size: int,
+    stamp: str = "",
+) -> np.ndarray:
+    """
+
+    Computes the outputs of a frozen model on a set of images once, and caches them in
+    an NPY file that is memory-mapped when reused. The stamp of the dataset and the
+    labels are cached next to the features, which are computed again if either doesn't
+    match, e.g. for a selection made again under the same name.
+
+    :param backbone: frozen model mapping images to feature vectors
+    :param images: image data, with shape [n_images, x_dim, y_dim, n_channels], or a
+    tf.data.Dataset of (image, label) pairs read in the order of the labels
+    :param labels: categorical variables with shape [n_images,]
+    :param path: path of the NPY file of features
+    :param batch_size: number of images run through the model at once
+    :param stamp: identifies the contents of the dataset, see selection.selection_stamp
+    :return: memory-mapped array of features, [n_images, n_features]
+    """
+    labels_path = path.replace(".npy", "_labels.npy")
+    stamp_path = path.replace(".npy", "_stamp.json")
+
+    if (
+        os.path.exists(path)
+        and os.path.exists(labels_path)
+        and os.path.exists(stamp_path)
+    ):
+        with open(stamp_path, "r") as inf:
+            cached_stamp = json.load(inf)["stamp"]
+
+        if cached_stamp == stamp and np.array_equal(np.load(labels_path), labels):
+            return np.load(path, mmap_mode="r")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # the stamp is written last and marks the cache valid, so an interrupted run can't
+    # leave new features next to the labels and stamp of old ones
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+
+    if isinstance(images, tf.data.Dataset):
+        batches = images.map(lambda img, label: img).batch(batch_size)
+    else:
+        batches = (
+            images[start : start + batch_size]
+            for start in range(0, len(images), batch_size)
+        )
+
+    # filling the file batch by batch, so the features never have to fit in memory
+    temp_path = f"{path}.partial"
+    features = np.lib.format.open_memmap(
+        temp_path,
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(labels), backbone.output_shape[-1]),
+    )
+    start = 0
+
+    for batch in batches:
+        batch_features = np.asarray(backbone.predict_on_batch(batch))
+        features[start : start + len(batch_features)] = batch_features
+        start += len(batch_features)
+
+    features.flush()
+    del features
+
+    os.replace(temp_path, path)
+    np.save(labels_path, labels)
+
+    with open(stamp_path, "w") as outf:
+        json.dump({"stamp": stamp}, outf)
+
+    return np.load(path, mmap_mode="r")
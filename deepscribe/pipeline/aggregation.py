@@ -3,14 +3,372 @@
 import luigi
 import os
 from tqdm import tqdm
+import csv
 import cv2
-import h5py
+import hashlib
+import numpy as np
+import tarfile
+import time
 import unicodedata
+import zipfile
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from deepscribe.pipeline.archive import (
+    create_archive,
+    open_archive,
+    archive_stamp,
+    image_hash,
+    previous_images,
+    replacing_path,
+    LAYOUTS,
+)
+
+# bundles of hotspot images that can be ingested without extracting them
+BUNDLE_EXTENSIONS = [".tar.gz", ".tgz", ".tar", ".zip"]
+
+
+def bundle_extension(path: str) -> str:
+    """
+
+    :param path: path to an image folder or bundle
+    :return: the bundle extension of the path, empty string for folders
+    """
+
+    for ext in BUNDLE_EXTENSIONS:
+        if path.endswith(ext):
+            return ext
+
+    return ""
+
+
+def dataset_name(imgfolder: str) -> str:
+    """
+
+    Name of the dataset used in the names of all derived archives. Bundles are named
+    like the folder they would be extracted to.
+
+    :param imgfolder: path to an image folder or bundle
+    :return: str
+    """
+
+    name = os.path.basename(imgfolder)
+    ext = bundle_extension(name)
+
+    return name[: -len(ext)] if ext else name
+
+
+def scan_folder(folder: str) -> Dict[str, Tuple[int, float]]:
+    """
+
+    Lists the files in a folder with the stat information used to detect changes.
+
+    :param folder: path to the image folder
+    :return: dict mapping NFC-normalized filenames to (size, mtime)
+    """
+
+    return {
+        unicodedata.normalize("NFC", entry.name): (
+            entry.stat().st_size,
+            entry.stat().st_mtime,
+        )
+        for entry in os.scandir(folder)
+        if entry.is_file()
+    }
+
+
+def zip_member_name(info: zipfile.ZipInfo) -> str:
+    """
+
+    Filename of a zip member, without directories. Zip tools that don't set the UTF-8
+    flag still tend to write UTF-8 names, which zipfile then decodes as cp437.
+
+    :param info: zipfile.ZipInfo
+    :return: NFC-normalized filename
+    """
+
+    name = info.filename
+
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode("cp437").decode("utf-8")
+        except UnicodeError:
+            pass
+
+    return unicodedata.normalize("NFC", os.path.basename(name))
+
+
+def _unique_members(
+    bundle: str, members: Iterator[Tuple[str, Tuple[int, float]]]
+) -> Dict:
+    """
+
+    Collects the listing of a bundle, rejecting members with the same filename in
+    different directories, as they would be stored under the same image name.
+
+    :param bundle: path to the bundle
+    :param members: iterator of (filename, (size, mtime))
+    :return: dict mapping filenames to (size, mtime)
+    """
+
+    listing = {}
+
+    for file, stat in members:
+        if file in listing:
+            raise ValueError(
+                f"{bundle} contains more than one member named {file}. Directories "
+                f"inside bundles are flattened, so filenames have to be unique."
+            )
+        listing[file] = stat
+
+    return listing
+
+
+@lru_cache(maxsize=8)
+def _scan_bundle(bundle: str, size: int, mtime: float) -> Dict[str, Tuple[int, float]]:
+    """
+
+    Lists a bundle, cached by its size and mtime so the completeness check and the run
+    of a task share a single pass over a compressed tar stream.
+
+    :param bundle: path to the bundle
+    :param size: size of the bundle file
+    :param mtime: mtime of the bundle file
+    :return: dict mapping NFC-normalized member filenames to (size, mtime)
+    """
+
+    if bundle_extension(bundle) == ".zip":
+        with zipfile.ZipFile(bundle) as zf:
+            return _unique_members(
+                bundle,
+                (
+                    (
+                        zip_member_name(info),
+                        (info.file_size, time.mktime(info.date_time + (0, 0, -1))),
+                    )
+                    for info in zf.infolist()
+                    if not info.is_dir()
+                ),
+            )
+
+    with tarfile.open(bundle, "r:*") as tar:
+        return _unique_members(
+            bundle,
+            (
+                (
+                    unicodedata.normalize("NFC", os.path.basename(member.name)),
+                    (member.size, float(member.mtime)),
+                )
+                for member in tar
+                if member.isfile()
+            ),
+        )
+
+
+def scan_bundle(bundle: str) -> Dict[str, Tuple[int, float]]:
+    """
+
+    Lists the members of a tar or zip bundle with the stat information used to detect
+    changes. Directories inside the bundle are flattened, and filenames have to be
+    unique across them.
+
+    :param bundle: path to the bundle
+    :return: dict mapping NFC-normalized member filenames to (size, mtime)
+    """
+
+    stat = os.stat(bundle)
+
+    return dict(_scan_bundle(bundle, stat.st_size, stat.st_mtime))
+
+
+def scan_source(imgfolder: str) -> Dict[str, Tuple[int, float]]:
+    """
+
+    :param imgfolder: path to an image folder or bundle
+    :return: dict mapping NFC-normalized filenames to (size, mtime)
+    """
+
+    return (
+        scan_bundle(imgfolder)
+        if bundle_extension(imgfolder)
+        else scan_folder(imgfolder)
+    )
+
+
+def read_bundle(bundle: str, files: List[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+
+    Streams the contents of bundle members in memory, without extracting them.
+
+    Zip members are read in the requested order. Compressed tar streams can't be read
+    out of order efficiently, so the requested tar members are yielded in the order they
+    are stored, in a single sequential pass. See ordered_members to read them in the
+    requested order.
+
+    :param bundle: path to the bundle
+    :param files: NFC-normalized filenames of the members to read
+    :return: iterator of (filename, bytes)
+    """
+
+    if bundle_extension(bundle) == ".zip":
+        with zipfile.ZipFile(bundle) as zf:
+            infos = {
+                zip_member_name(info): info
+                for info in zf.infolist()
+                if not info.is_dir()
+            }
+
+            for file in files:
+                yield file, zf.read(infos[file])
+    else:
+        wanted = set(files)
+
+        with tarfile.open(bundle, "r:*") as tar:
+            for member in tar:
+                file = unicodedata.normalize("NFC", os.path.basename(member.name))
+
+                if member.isfile() and file in wanted:
+                    yield file, tar.extractfile(member).read()
+
+
+def ordered_members(bundle: str, files: List[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+
+    Reads bundle members in the requested order, in a single pass over the bundle.
+    Members stored ahead of their turn are held in memory, still encoded, so a bundle
+    stored in the requested order is streamed without holding any.
+
+    :param bundle: path to the bundle
+    :param files: NFC-normalized filenames of the members to read, in order
+    :return: iterator of (filename, bytes)
+    """
+
+    members = read_bundle(bundle, files)
+    pending = {}
+
+    for file in files:
+        while file not in pending:
+            member, data = next(members)
+            pending[member] = data
+
+        yield file, pending.pop(file)
+
+
+def decode_hotspot(data: bytes, fname: str, origin: str):
+    """
+
+    Decodes a hotspot image in grayscale and parses its filename according to the OCHRE
+    spec (sign_imageuuid_objuuid).
+
+    :param data: encoded image
+    :param fname: filename of the image, NFC-normalized
+    :param origin: location of the image, stored as metadata
+    :return: tuple (file_hash, hotspot). hotspot is a tuple (sign, img, metadata dict),
+    or None if the file could not be decoded.
+    """
+
+    file_hash = hashlib.sha1(data).hexdigest()
+
+    # decoding image in grayscale
+    img = (
+        cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if data
+        else None
+    )
+
+    if img is None:
+        return file_hash, None
+
+    # parsing filename according to OCHRE spec
+    fname = os.path.splitext(fname)[0]
+
+    sign, image_uuid, obj_uuid = fname.split("_")
+
+    metadata = {
+        "name": fname,
+        "image_uuid": image_uuid,
+        "obj_uuid": obj_uuid,
+        "sign": sign,
+        "origin": origin,
+        "file_hash": file_hash,
+        "content_hash": image_hash(img),
+    }
+
+    return file_hash, (sign, img, metadata)
+
+
+def load_hotspot(path: str):
+    """
+
+    Loads a single hotspot image from disk. Module-level so that it can be dispatched to
+    a process pool.
+
+    :param path: path to the image file, with NFC-normalized filename.
+    :return: see decode_hotspot
+    """
+
+    with open(path, "rb") as imgf:
+        data = imgf.read()
+
+    return decode_hotspot(data, os.path.basename(path), path)
+
+
+def bounded_imap(
+    pool: Pool, func: Callable, jobs: Iterable, chunksize: int, max_chunks: int
+) -> Iterator:
+    """
+
+    Maps a function over jobs with a process pool, yielding the results in order like
+    Pool.imap. Pool.imap reads every job ahead and keeps every result until it is
+    consumed, so only max_chunks chunks of jobs are handed to the pool at a time here,
+    bounding the memory held when the consumer is slower than the workers.
+
+    :param pool: process pool
+    :param func: module-level function
+    :param jobs: iterable of arguments of func
+    :param chunksize: number of jobs sent to a worker at once
+    :param max_chunks: number of chunks submitted but not yet consumed
+    :return: iterator of results
+    """
+
+    jobs = iter(jobs)
+    in_flight = deque()
+
+    def submit():
+        chunk = list(islice(jobs, chunksize))
+
+        if chunk:
+            in_flight.append(pool.map_async(func, chunk, chunksize=len(chunk)))
+
+    for _ in range(max_chunks):
+        submit()
+
+    while in_flight:
+        results = in_flight.popleft().get()
+        submit()
+
+        yield from results
+
+
+def load_bundle_member(member: Tuple[bytes, str, str]):
+    """
+
+    Decodes a single hotspot image read from a bundle. Module-level so that it can be
+    dispatched to a process pool.
+
+    :param member: tuple (bytes, filename, origin)
+    :return: see decode_hotspot
+    """
+
+    return decode_hotspot(*member)
 
 
 class OchreDatasetTask(luigi.ExternalTask):
     """
-    An ExternalTask requiring the presence of folder containing images of PFA hotspots.
+    An ExternalTask requiring the presence of folder containing images of PFA hotspots,
+    or of a .tar, .tar.gz or .zip bundle of them.
 
     """
 
@@ -29,13 +387,21 @@ class OchreDatasetTask(luigi.ExternalTask):
 class OchreToHD5Task(luigi.Task):
     """
 
-    Converts a folder of OCHRE hotspots into a single HDF5 archive
+    Converts a folder (or bundle) of OCHRE hotspots into a single HDF5 archive
 
     """
 
     # location of image folder
     imgfolder = luigi.Parameter()
     hdffolder = luigi.Parameter()
+    # number of processes decoding images. Does not change the output.
+    workers = luigi.IntParameter(default=1, significant=False)
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups")
+    # only ingest added or changed images into an existing archive
+    incremental = luigi.BoolParameter(default=False, significant=False)
+    # store images with identical pixels only once. Readers return the same images
+    # either way.
+    deduplicate = luigi.BoolParameter(default=False, significant=False)
 
     def requires(self):
         """
@@ -46,56 +412,261 @@ class OchreToHD5Task(luigi.Task):
 
         return OchreDatasetTask(self.imgfolder)
 
+    def complete(self):
+        """
+
+        In incremental mode, the archive is only complete if its manifest matches the
+        current contents of the image folder.
+
+        :return: bool
+        """
+
+        if (
+            not self.incremental
+            or not self.output().exists()
+            or not self.input().exists()
+        ):
+            return super().complete()
+
+        with open_archive(self.output().path) as archive:
+            manifest = archive.manifest()
+
+        return {
+            file: (size, mtime) for file, (size, mtime, _) in manifest.items()
+        } == scan_source(self.input().path)
+
     def run(self):
 
         """
 
         Copies the images into a single HDF5 archive with metadata from the filenames preserved.
+        A manifest of the source files is stored alongside the images.
+
+        In incremental mode, images whose file size and mtime match the manifest of the
+        existing archive are copied from it instead of being decoded again.
 
         :return: None
         """
 
-        # open temporary path
+        # normalize filepaths!
+        source = self.input().path
+        files = scan_source(source)
 
-        with self.output().temporary_path() as self.temp_output_path:
-            archive = h5py.File(self.temp_output_path, "w")
-            # iterate through directory, copy images
+        previous = (
+            open_archive(self.output().path)
+            if self.incremental and self.output().exists()
+            else None
+        )
+        previous_manifest = previous.manifest() if previous is not None else {}
+
+        reused = {
+            file
+            for file, stat in files.items()
+            if file in previous_manifest and previous_manifest[file][:2] == stat
+        }
+
+        # images are written grouped by sign, in the same order as the labels of the
+        # archive
+        ordered_files = sorted(files, key=lambda file: (file.split("_")[0], file))
+
+        decode_files = [file for file in ordered_files if file not in reused]
+
+        manifest = {}
+        names = []
+        file_hashes = []
+
+        # an existing archive is replaced atomically
+        with (
+            replacing_path(self.output())
+            if previous is not None
+            else self.output().temporary_path()
+        ) as self.temp_output_path:
+            archive = create_archive(
+                self.temp_output_path, self.layout, self.deduplicate
+            )
+
+            # bundle members are read by this process and decoded in memory,
+            # files in a folder are read by the decoding processes.
+            if bundle_extension(source):
+                loader = load_bundle_member
+                jobs = (
+                    (data, file, "{}/{}".format(source, file))
+                    for file, data in ordered_members(source, decode_files)
+                )
+            else:
+                loader = load_hotspot
+                jobs = ["{}/{}".format(source, file) for file in decode_files]
+
+            # decoding is spread over the pool, this process is the only writer. results
+            # come in the order of the files, with a few chunks per worker in flight.
+            pool = Pool(self.workers) if self.workers > 1 else None
+            decoded = iter(
+                bounded_imap(
+                    pool, loader, jobs, chunksize=64, max_chunks=4 * self.workers
+                )
+                if pool is not None
+                else map(loader, jobs)
+            )
+
+            previous_label = None
+            previous_label_images = {}
+
+            try:
+                for file in tqdm(ordered_files):
+                    if file in reused:
+                        file_hash = previous_manifest[file][2]
+                        sign = file.split("_")[0]
+
+                        if sign != previous_label:
+                            previous_label = sign
+                            previous_label_images = previous_images(previous, sign)
+
+                        key = (os.path.splitext(file)[0], file_hash)
+                        hotspot = None
+
+                        if key in previous_label_images:
+                            img, metadata = previous_label_images[key]
+                            metadata.setdefault("content_hash", image_hash(img))
+                            hotspot = (sign, img, metadata)
+                    else:
+                        file_hash, hotspot = next(decoded)
+
+                    manifest[file] = files[file] + (file_hash,)
+
+                    if hotspot is None:
+                        continue
+
+                    # images are labeled by sign
+                    sign, img, metadata = hotspot
+                    archive.add(sign, img, metadata)
+
+                    names.append(metadata["name"])
+                    file_hashes.append(file_hash)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+            archive.write_manifest(manifest)
+            archive.attrs["stamp"] = archive_stamp(names, file_hashes)
+            archive.close()
 
-            for f in tqdm(os.listdir(self.input().path)):
+            if previous is not None:
+                previous.close()
 
-                # normalize filepaths!
-                file = unicodedata.normalize("NFC", f)
+    def output(self):
+        """
 
-                # loading image from disk in grayscale
-                img = cv2.imread(
-                    "{}/{}".format(self.input().path, file), cv2.IMREAD_GRAYSCALE
-                )
+        HDF5 archive containing contents of the folder.
 
-                if img is not None:
-                    # parsing filename according to OCHRE spec
-                    fname = os.path.splitext(file)[0]
+        :return: luigi.LocalTarget
+        """
 
-                    sign, image_uuid, obj_uuid = fname.split("_")
-                    # creating groups for signs
-                    # requiring bytestrings
-                    current_group = archive.require_group(sign)
+        return luigi.LocalTarget(
+            "{}/{}{}.h5".format(
+                self.hdffolder,
+                dataset_name(self.imgfolder),
+                "_ragged" if self.layout == "ragged" else "",
+            )
+        )
 
-                    dset = current_group.create_dataset(fname, data=img)
-                    dset.attrs["image_uuid"] = image_uuid
-                    dset.attrs["obj_uuid"] = obj_uuid
-                    dset.attrs["sign"] = sign
-                    dset.attrs["origin"] = "{}/{}".format(self.input().path, file)
 
-            archive.close()
+class DuplicateReportTask(luigi.Task):
+    """
+
+    Lists the groups of hotspots with identical pixel content in the OCHRE archive, as a
+    CSV file with one row per image. Groups spanning more than one sign are labeled
+    inconsistently.
+
+    """
+
+    imgfolder = luigi.Parameter()
+    hdffolder = luigi.Parameter()
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups")
+
+    def requires(self):
+        """
+
+        :return: OchreToHD5Task
+        """
+
+        return OchreToHD5Task(
+            imgfolder=self.imgfolder, hdffolder=self.hdffolder, layout=self.layout
+        )
+
+    def run(self):
+        """
+
+        Groups the images by content hash, using the metadata table only.
+
+        :return: None
+        """
+
+        with open_archive(self.input().path) as archive:
+            metadata = archive.metadata
+
+            if "content_hash" not in metadata:
+                raise ValueError(
+                    f"{self.input().path} has no content hashes, rebuild it to report "
+                    f"duplicates."
+                )
+
+            groups = {}
+
+            for i, content_hash in enumerate(metadata["content_hash"]):
+                groups.setdefault(content_hash, []).append(i)
+
+            duplicates = {
+                content_hash: idx
+                for content_hash, idx in groups.items()
+                if len(idx) > 1
+            }
+
+            n_duplicates = sum(len(idx) - 1 for idx in duplicates.values())
+            self.set_status_message(
+                f"{n_duplicates} of {len(archive)} images are duplicates, "
+                f"in {len(duplicates)} groups"
+            )
+
+            with self.output().temporary_path() as temppath:
+                with open(temppath, "w", newline="") as outf:
+                    writer = csv.writer(outf)
+                    writer.writerow(
+                        [
+                            "content_hash",
+                            "group_size",
+                            "n_signs",
+                            "name",
+                            "sign",
+                            "image_uuid",
+                            "obj_uuid",
+                        ]
+                    )
+
+                    for content_hash, idx in duplicates.items():
+                        n_signs = len(set(archive.image_labels[i] for i in idx))
+
+                        for i in idx:
+                            writer.writerow(
+                                [
+                                    content_hash,
+                                    len(idx),
+                                    n_signs,
+                                    metadata["name"][i],
+                                    archive.image_labels[i],
+                                    metadata["image_uuid"][i],
+                                    metadata["obj_uuid"][i],
+                                ]
+                            )
 
     def output(self):
         """
 
-        HDF5 archive containing contents of the folder.
+        CSV file listing the duplicates.
 
         :return: luigi.LocalTarget
         """
 
         return luigi.LocalTarget(
-            "{}/{}.h5".format(self.hdffolder, os.path.basename(self.imgfolder))
+            "{}/{}_duplicates.csv".format(self.hdffolder, dataset_name(self.imgfolder))
         )
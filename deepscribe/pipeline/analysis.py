@@ -1,6 +1,7 @@
 import luigi
 from .training import TrainKerasModelFromDefinitionTask
-from .selection import SelectDatasetTask
+from .selection import SelectDatasetTask, load_selection, load_images, selection_name
+from .archive import PRECISIONS
 from sklearn.metrics import confusion_matrix, classification_report
 import numpy as np
 from abc import ABC
@@ -9,13 +10,30 @@ import tensorflow.keras as kr
 import tensorflow as tf
 import matplotlib
 from pathlib import Path
-import json
 
 matplotlib.use("Agg")
 # import matplotlib.backends.backend_pdf
 import matplotlib.pyplot as plt
 
 
+def predict(model: kr.Model, images: np.ndarray) -> np.ndarray:
+    """
+
+    Runs a model on single-channel images. Models saved before the RGB architectures
+    took single-channel input expect three channels, so the channel is repeated for
+    them.
+
+    :param model: trained Keras model
+    :param images: array of images, [n_images, x_dim, y_dim, 1]
+    :return: array of predicted class probabilities, [n_images, n_classes]
+    """
+
+    if model.input_shape[-1] == 3:
+        images = np.repeat(images, 3, axis=3)
+
+    return model.predict(images)
+
+
 class AnalysisTask(luigi.Task, ABC):
     """
     Abstract class that requires the completion of dataset selection and model training.
@@ -36,6 +54,17 @@ class AnalysisTask(luigi.Task, ABC):
     )  # set the remaining as "other" - not recommended for small keep_category lengths
     whiten = luigi.BoolParameter(default=False)
     epsilon = luigi.FloatParameter(default=0.1)
+    # data the whitening is fitted on, see SelectDatasetTask
+    whiten_source = luigi.ChoiceParameter(
+        choices=["selection", "archive"], default="selection"
+    )
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # format of the selected dataset, see SelectDatasetTask
+    output_format = luigi.ChoiceParameter(
+        choices=["npz", "npy", "index", "tfrecord"], default="npz"
+    )
+    # size of the OTHER sample, see SelectDatasetTask
+    max_other = luigi.IntParameter(default=0)
 
     def requires(self):
         """
@@ -58,6 +87,10 @@ class AnalysisTask(luigi.Task, ABC):
                 self.rest_as_other,
                 self.whiten,
                 self.epsilon,
+                whiten_source=self.whiten_source,
+                precision=self.precision,
+                output_format=self.output_format,
+                max_other=self.max_other,
             ),
             "dataset": SelectDatasetTask(
                 self.imgfolder,
@@ -70,6 +103,10 @@ class AnalysisTask(luigi.Task, ABC):
                 self.rest_as_other,
                 self.whiten,
                 self.epsilon,
+                whiten_source=self.whiten_source,
+                precision=self.precision,
+                output_format=self.output_format,
+                max_other=self.max_other,
             ),
         }
 
@@ -90,19 +127,12 @@ class PlotConfusionMatrixTask(AnalysisTask):
 
         # load TF model and dataset
         model = kr.models.load_model(self.input()["model"].path)
-        data = np.load(self.input()["dataset"].path)
+        data = load_selection(self.input()["dataset"].path)
 
         # make predictions on data
 
-        with open(self.model_definition, "r") as modelf:
-            model_params = json.load(modelf)
-
         # (batch_size, num_classes)
-        pred_logits = model.predict(
-            np.repeat(data["test_imgs"], 3, axis=3)
-            if "architecture" in model_params
-            else data["test_imgs"]
-        )
+        pred_logits = predict(model, load_images(data, "test"))
 
         # computing predicted labels
         pred_labels = np.argmax(pred_logits, axis=1)
@@ -113,8 +143,6 @@ class PlotConfusionMatrixTask(AnalysisTask):
 
         # get labels from dataset
 
-        data = np.load(self.input()["dataset"].path)
-
         class_labels = data["classes"]
         fig = plt.figure(figsize=(13, 13))
         ax = fig.add_subplot(111)
@@ -138,12 +166,10 @@ class PlotConfusionMatrixTask(AnalysisTask):
         """
 
         p = Path(self.model_definition)
-        p_data = Path(self.input()["dataset"].path)
+        data_name = selection_name(self.input()["dataset"].path)
 
         return luigi.LocalTarget(
-            "{}/{}_{}/confustion_test.png".format(
-                self.modelsfolder, p.stem, p_data.stem
-            )
+            "{}/{}_{}/confustion_test.png".format(self.modelsfolder, p.stem, data_name)
         )
 
 
@@ -163,23 +189,12 @@ class GenerateClassificationReportTask(AnalysisTask):
         """
         # load TF model and dataset
         model = kr.models.load_model(self.input()["model"].path)
-        data = np.load(self.input()["dataset"].path)
+        data = load_selection(self.input()["dataset"].path)
 
         # make predictions on data
 
-        # load model description, check if it's being transferred from an RGB model
-
-        # TODO: better way of saving and loading models and handling this edge case
-
-        with open(self.model_definition, "r") as modelf:
-            model_params = json.load(modelf)
-
         # (batch_size, num_classes)
-        pred_logits = model.predict(
-            np.repeat(data["test_imgs"], 3, axis=3)
-            if "architecture" in model_params
-            else data["test_imgs"]
-        )
+        pred_logits = predict(model, load_images(data, "test"))
 
         # computing predicted labels
         pred_labels = np.argmax(pred_logits, axis=1)
@@ -203,11 +218,11 @@ class GenerateClassificationReportTask(AnalysisTask):
         """
 
         p = Path(self.model_definition)
-        p_data = Path(self.input()["dataset"].path)
+        data_name = selection_name(self.input()["dataset"].path)
 
         return luigi.LocalTarget(
             "{}/{}_{}/classification_report.txt".format(
-                self.modelsfolder, p.stem, p_data.stem
+                self.modelsfolder, p.stem, data_name
             )
         )
 
@@ -229,17 +244,11 @@ class PlotIncorrectTask(AnalysisTask):
 
         # load TF model and dataset
         model = kr.models.load_model(self.input()["model"].path)
-        data = np.load(self.input()["dataset"].path)
-
-        with open(self.model_definition, "r") as modelf:
-            model_params = json.load(modelf)
+        data = load_selection(self.input()["dataset"].path)
+        test_imgs = load_images(data, "test")
 
         # (batch_size, num_classes)
-        pred_logits = model.predict(
-            np.repeat(data["test_imgs"], 3, axis=3)
-            if "architecture" in model_params
-            else data["test_imgs"]
-        )
+        pred_logits = predict(model, test_imgs)
         # (batch_size,)
 
         pred_labels = np.argmax(pred_logits, axis=1)
@@ -253,7 +262,7 @@ class PlotIncorrectTask(AnalysisTask):
         for i, (ix, iy) in enumerate(np.ndindex(axarr.shape)):
 
             indx = incorrect_prediction_idx[i]
-            img = np.squeeze(data["test_imgs"][indx, :, :])
+            img = np.squeeze(test_imgs[indx, :, :])
             ground_truth = data["classes"][data["test_labels"][indx]]
             pred_label = data["classes"][pred_labels[indx]]
 
@@ -274,11 +283,11 @@ class PlotIncorrectTask(AnalysisTask):
         """
 
         p = Path(self.model_definition)
-        p_data = Path(self.input()["dataset"].path)
+        data_name = selection_name(self.input()["dataset"].path)
 
         return luigi.LocalTarget(
             "{}/{}_{}/test_misclassified_sample.png".format(
-                self.modelsfolder, p.stem, p_data.stem
+                self.modelsfolder, p.stem, data_name
             )
         )
 
@@ -304,6 +313,17 @@ class RunAnalysisOnTestDataTask(luigi.WrapperTask):
     )  # set the remaining as "other" - not recommended for small keep_category lengths
     whiten = luigi.BoolParameter(default=False)
     epsilon = luigi.FloatParameter(default=0.1)
+    # data the whitening is fitted on, see SelectDatasetTask
+    whiten_source = luigi.ChoiceParameter(
+        choices=["selection", "archive"], default="selection"
+    )
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # format of the selected dataset, see SelectDatasetTask
+    output_format = luigi.ChoiceParameter(
+        choices=["npz", "npy", "index", "tfrecord"], default="npz"
+    )
+    # size of the OTHER sample, see SelectDatasetTask
+    max_other = luigi.IntParameter(default=0)
 
     def requires(self):
         """
@@ -325,6 +345,10 @@ class RunAnalysisOnTestDataTask(luigi.WrapperTask):
                 self.rest_as_other,
                 self.whiten,
                 self.epsilon,
+                whiten_source=self.whiten_source,
+                precision=self.precision,
+                output_format=self.output_format,
+                max_other=self.max_other,
             ),
             PlotConfusionMatrixTask(
                 self.imgfolder,
@@ -339,6 +363,10 @@ class RunAnalysisOnTestDataTask(luigi.WrapperTask):
                 self.rest_as_other,
                 self.whiten,
                 self.epsilon,
+                whiten_source=self.whiten_source,
+                precision=self.precision,
+                output_format=self.output_format,
+                max_other=self.max_other,
             ),
             PlotIncorrectTask(
                 self.imgfolder,
@@ -353,5 +381,9 @@ class RunAnalysisOnTestDataTask(luigi.WrapperTask):
                 self.rest_as_other,
                 self.whiten,
                 self.epsilon,
+                whiten_source=self.whiten_source,
+                precision=self.precision,
+                output_format=self.output_format,
+                max_other=self.max_other,
             ),
         ]
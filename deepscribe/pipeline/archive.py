@@ -0,0 +1,815 @@
+# reading and writing the HDF5 image archives passed between pipeline tasks
+#
+# Two layouts are supported:
+#
+# groups: one HDF5 group per label, one dataset per image, metadata stored as dataset
+#         attrs and as a columnar table in the reserved _metadata group.
+# ragged: every image flattened into one contiguous pixel buffer, with offset, shape
+#         and label index arrays and one column per metadata key. Images are stored
+#         grouped by label, so a label is a single contiguous slice of the pixel buffer.
+#
+# Byte-identical images can be stored once: later occurrences are hard links to the
+# first one (groups) or point to its pixels (ragged), and the duplicate_of column holds
+# the index of the first occurrence, or -1.
+#
+# Groups whose name starts with an underscore are reserved for archive-level tables,
+# e.g. the manifest of source files. Signs never start with an underscore, since
+# filenames are split on it.
+
+import h5py
+import hashlib
+import luigi
+import os
+import random
+import numpy as np
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+LAYOUTS = ["groups", "ragged"]
+# storage precisions of processed images. uint8 images are stored with a per-image scale
+# and offset.
+PRECISIONS = ["float32", "float16", "uint8"]
+
+
+def _read_strings(dset: h5py.Dataset) -> List[str]:
+    """
+
+    Reads a variable-length string dataset as a list of str, independent of the h5py
+    version.
+
+    :param dset: h5py.Dataset
+    :return: list of str
+    """
+    return [val.decode("utf-8") if isinstance(val, bytes) else val for val in dset[()]]
+
+
+def _write_column(group: h5py.Group, key: str, values: list):
+    """
+
+    Writes a list of metadata values as a dataset, using variable-length strings for
+    text.
+
+    :param group: h5py.Group receiving the column
+    :param key: name of the column
+    :param values: list of values, one per image
+    :return: None
+    """
+    if all(isinstance(val, str) for val in values):
+        group.create_dataset(
+            key, data=np.array(values, dtype=object), dtype=h5py.string_dtype()
+        )
+    else:
+        group.create_dataset(key, data=np.asarray(values))
+
+
+def image_hash(img: np.ndarray) -> str:
+    """
+
+    Hashes the pixel content of an image, including its shape and dtype.
+
+    :param img: np.ndarray
+    :return: hex digest
+    """
+    digest = hashlib.sha1(f"{img.dtype.str}{img.shape}".encode("utf-8"))
+    digest.update(np.ascontiguousarray(img).data)
+
+    return digest.hexdigest()
+
+
+def quantize(
+    images: List[np.ndarray], metadata: Dict[str, list], precision: str
+) -> Tuple[List[np.ndarray], Dict[str, list]]:
+    """
+
+    Converts processed images to a storage precision. For uint8, each image is mapped
+    onto the full 0-255 range, and the scale and offset undoing this are recorded in the
+    "scale" and "offset" metadata columns.
+
+    :param images: list of float images
+    :param metadata: dict mapping metadata keys to lists of values
+    :param precision: one of PRECISIONS
+    :return: list of converted images, metadata with the scale and offset columns set or
+    removed
+    """
+    metadata = {
+        key: vals for key, vals in metadata.items() if key not in ["scale", "offset"]
+    }
+
+    if precision != "uint8":
+        return [img.astype(precision) for img in images], metadata
+
+    quantized = []
+    metadata["scale"] = []
+    metadata["offset"] = []
+
+    for img in images:
+        offset = float(img.min()) if img.size > 0 else 0.0
+        scale = (float(img.max()) - offset) / 255.0 if img.size > 0 else 0.0
+
+        quantized.append(
+            np.round((img - offset) / scale).astype(np.uint8)
+            if scale > 0
+            else np.zeros(img.shape, dtype=np.uint8)
+        )
+        metadata["scale"].append(scale)
+        metadata["offset"].append(offset)
+
+    return quantized, metadata
+
+
+def dequantize(images: List[np.ndarray], metadata: Dict[str, list]) -> List[np.ndarray]:
+    """
+
+    Converts images stored by quantize back to float32. Other images, e.g. the original
+    uint8 images of an OchreToHD5Task archive, are returned unchanged.
+
+    :param images: list of images as read from an archive
+    :param metadata: dict mapping metadata keys to lists of values
+    :return: list of images
+    """
+    if "scale" in metadata:
+        return [
+            img.astype(np.float32) * np.float32(scale) + np.float32(offset)
+            for img, scale, offset in zip(images, metadata["scale"], metadata["offset"])
+        ]
+
+    return [
+        img.astype(np.float32) if img.dtype == np.float16 else img for img in images
+    ]
+
+
+def archive_stamp(names: List[str], file_hashes: List[str]) -> str:
+    """
+
+    Computes a digest identifying the set of source images in an archive. Processed
+    archives carry the stamp of the archive they were computed from, so a change in the
+    source images can be detected downstream.
+
+    :param names: image names
+    :param file_hashes: content hashes of the source files of the images
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+
+    for name, file_hash in sorted(zip(names, file_hashes)):
+        digest.update(f"{name}:{file_hash}\n".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+@contextmanager
+def replacing_path(target: luigi.LocalTarget):
+    """
+
+    Like luigi.LocalTarget.temporary_path, but atomically replaces the target if it
+    already exists, as required when an archive is updated in place.
+
+    :param target: luigi.LocalTarget
+    :return: temporary path to write to
+    """
+    target.makedirs()
+    temp_path = "{}-luigi-tmp-{:010}".format(target.path, random.randrange(0, 10 ** 10))
+
+    yield temp_path
+
+    os.replace(temp_path, target.path)
+
+
+def previous_images(
+    reader, label: str
+) -> Dict[Tuple[str, str], Tuple[np.ndarray, Dict]]:
+    """
+
+    Indexes the images of one label of a previously written archive by (name,
+    file_hash), so that images whose source file did not change can be reused by
+    incremental runs.
+
+    :param reader: ArchiveReader of the previous archive, or None
+    :param label: label to index
+    :return: dict mapping (name, file_hash) to (image, metadata dict), empty if nothing
+    can be reused
+    """
+    if reader is None or label not in reader.labels():
+        return {}
+
+    images, metadata = reader.read_label(label)
+    images = dequantize(images, metadata)
+
+    if "file_hash" not in metadata:
+        return {}
+
+    return {
+        (metadata["name"][i], metadata["file_hash"][i]): (
+            img,
+            {key: vals[i] for key, vals in metadata.items()},
+        )
+        for i, img in enumerate(images)
+    }
+
+
+def _read_columns(group: h5py.Group) -> Dict[str, list]:
+    """
+
+    Reads every column of a metadata table.
+
+    :param group: h5py.Group with one dataset per column
+    :return: dict mapping column names to lists of values
+    """
+    return {
+        key: _read_strings(dset)
+        if h5py.check_string_dtype(dset.dtype)
+        else list(dset[()])
+        for key, dset in group.items()
+    }
+
+
+class ArchiveReader:
+    """
+    Common interface of the archive readers. Metadata is held as a columnar table in
+    memory, with one row per image; image indices refer to rows of this table, and can
+    be found with query() without reading any pixels.
+
+    Subclasses have to set metadata, image_labels and label_rows on open, and implement
+    _read_rows.
+
+    """
+
+    def __init__(self, path: str):
+        self.archive = h5py.File(path, "r")
+        self.metadata = (
+            {}
+        )  # dict mapping metadata keys (including "name") to lists of values
+        self.image_labels = []  # label of each image
+        self.label_rows = {}  # dict mapping labels to arrays of image indices
+
+    def _index_labels(self):
+        """
+
+        Builds label_rows from image_labels.
+
+        :return: None
+        """
+        rows = {}
+
+        for i, label in enumerate(self.image_labels):
+            rows.setdefault(label, []).append(i)
+
+        self.label_rows = {
+            label: np.array(idx, dtype=np.int64) for label, idx in rows.items()
+        }
+
+    @property
+    def attrs(self) -> h5py.AttributeManager:
+        """
+
+        :return: archive-level attributes
+        """
+        return self.archive.attrs
+
+    def __len__(self) -> int:
+        return len(self.image_labels)
+
+    def labels(self) -> List[str]:
+        """
+
+        :return: list of labels in the archive
+        """
+        return list(self.label_rows)
+
+    def count(self, label: str) -> int:
+        """
+
+        :param label: label in the archive
+        :return: number of images with this label
+        """
+        return len(self.label_rows[label])
+
+    def counts(self, key: str = "label") -> Dict[str, int]:
+        """
+
+        Counts the images per value of a metadata column, e.g. counts("obj_uuid") for
+        the number of images per tablet.
+
+        :param key: "label" or a metadata key
+        :return: dict mapping values to number of images
+        """
+        column = self.image_labels if key == "label" else self.metadata[key]
+        values, counts = np.unique(np.array(column, dtype=object), return_counts=True)
+
+        return dict(zip(values, counts.tolist()))
+
+    def query(self, **conditions) -> np.ndarray:
+        """
+
+        Finds images by metadata, without reading pixel data, e.g. query(sign="na",
+        obj_uuid=[uuid1, uuid2]).
+
+        :param conditions: metadata key (or "label") mapped to a value or a list of
+        accepted values.
+        :return: sorted array of image indices matching all conditions
+        """
+        mask = np.ones(len(self), dtype=bool)
+
+        for key, accepted in conditions.items():
+            column = self.image_labels if key == "label" else self.metadata[key]
+            accepted = (
+                set(accepted)
+                if isinstance(accepted, (list, tuple, set))
+                else {accepted}
+            )
+            mask &= np.fromiter(
+                (val in accepted for val in column), dtype=bool, count=len(self)
+            )
+
+        return np.flatnonzero(mask)
+
+    def manifest(self) -> Dict[str, tuple]:
+        """
+
+        Reads the manifest of source files the archive was built from.
+
+        :return: dict mapping filenames to (size, mtime, file_hash), empty if the
+        archive has no manifest.
+        """
+        if "_manifest" not in self.archive:
+            return {}
+
+        columns = self.archive["_manifest"]
+
+        return {
+            file: (int(size), float(mtime), file_hash)
+            for file, size, mtime, file_hash in zip(
+                _read_strings(columns["file"]),
+                columns["size"][()],
+                columns["mtime"][()],
+                _read_strings(columns["file_hash"]),
+            )
+        }
+
+    def _read_rows(self, indices: np.ndarray) -> List[np.ndarray]:
+        """
+
+        Reads the pixels of the images with the given indices.
+
+        :param indices: array of image indices
+        :return: list of images
+        """
+        raise NotImplementedError
+
+    def read_indices(self, indices) -> Tuple[List[np.ndarray], Dict[str, list]]:
+        """
+
+        Reads the images with the given indices, in the given order.
+
+        :param indices: array of image indices, e.g. from query()
+        :return: list of images, dict mapping metadata keys (including "name") to lists
+        of values
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        metadata = {
+            key: [vals[i] for i in indices] for key, vals in self.metadata.items()
+        }
+
+        return self._read_rows(indices), metadata
+
+    def read_label(self, label: str) -> Tuple[List[np.ndarray], Dict[str, list]]:
+        """
+
+        Reads every image with the given label.
+
+        :param label: label in the archive
+        :return: list of images, dict mapping metadata keys (including "name") to lists
+        of values
+        """
+        return self.read_indices(self.label_rows[label])
+
+    def read_all(self) -> Tuple[List[str], List[np.ndarray], Dict[str, list]]:
+        """
+
+        Reads every image in the archive.
+
+        :return: list of labels, list of images, dict mapping metadata keys to lists of
+        values
+        """
+        images, metadata = self.read_indices(np.arange(len(self)))
+
+        return list(self.image_labels), images, metadata
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GroupArchiveReader(ArchiveReader):
+    """
+    Reads an archive in the "groups" layout. Metadata is loaded from the metadata table,
+    or collected from the dataset attrs for archives written without one.
+
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+
+        if "_metadata" in self.archive:
+            self.metadata = _read_columns(self.archive["_metadata"])
+            self.image_labels = self.metadata.pop("label")
+        else:
+            self._scan_metadata()
+
+        self._index_labels()
+
+    def _scan_metadata(self):
+        """
+
+        Collects the metadata from the attrs of every dataset.
+
+        :return: None
+        """
+        self.metadata = {"name": []}
+
+        for label, group in self.archive.items():
+            if label.startswith("_"):
+                continue
+
+            for name, dset in group.items():
+                self.image_labels.append(label)
+                self.metadata["name"].append(name)
+
+                for key, val in dset.attrs.items():
+                    self.metadata.setdefault(key, []).append(val)
+
+    def _read_rows(self, indices: np.ndarray) -> List[np.ndarray]:
+        return [
+            self.archive[self.image_labels[i]][self.metadata["name"][i]][()]
+            for i in indices
+        ]
+
+
+class RaggedArchiveReader(ArchiveReader):
+    """
+    Reads an archive in the "ragged" layout. Index arrays and metadata are loaded on
+    open, images stored back to back (e.g. a whole label) are read with a single slice
+    of the pixel buffer.
+
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+
+        self.shapes = self.archive["shapes"][()]
+        self.sizes = np.prod(self.shapes, axis=1, dtype=np.int64)
+        # start of the pixels of each image. Archives written before deduplication have
+        # an extra end offset.
+        self.offsets = self.archive["offsets"][: len(self.shapes)]
+        self.metadata = _read_columns(self.archive["metadata"])
+
+        label_names = _read_strings(self.archive["label_names"])
+        label_offsets = self.archive["label_offsets"][()]
+
+        for i, label in enumerate(label_names):
+            self.image_labels.extend(
+                [label] * int(label_offsets[i + 1] - label_offsets[i])
+            )
+
+        self._index_labels()
+
+    def _read_rows(self, indices: np.ndarray) -> List[np.ndarray]:
+        images = []
+
+        starts = self.offsets[indices]
+        ends = starts + self.sizes[indices]
+
+        # split into runs of images stored back to back, each run is a single read
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+
+        for run in np.split(np.arange(len(indices)), breaks):
+            if len(run) == 0:
+                continue
+
+            base = starts[run[0]]
+            pixels = self.archive["pixels"][base : ends[run[-1]]]
+
+            images.extend(
+                pixels[starts[k] - base : ends[k] - base].reshape(
+                    self.shapes[indices[k]]
+                )
+                for k in run
+            )
+
+        return images
+
+
+class GroupArchiveWriter:
+    """
+    Writes an archive in the "groups" layout.
+
+    With deduplicate set, images whose content_hash metadata was already written are
+    stored as hard links to the first occurrence. The linked dataset keeps the attrs of
+    the first occurrence, the metadata table holds the metadata of every image.
+
+    """
+
+    def __init__(self, path: str, deduplicate: bool = False):
+        self.archive = h5py.File(path, "w")
+        self.archive.attrs["layout"] = "groups"
+        self.deduplicate = deduplicate
+
+        # metadata table, written on close
+        self.image_labels = []
+        self.metadata = {}
+        # content hash -> (index, stored location) of its first occurrence
+        self.first_occurrences = {}
+
+    @property
+    def attrs(self) -> h5py.AttributeManager:
+        """
+
+        :return: archive-level attributes
+        """
+        return self.archive.attrs
+
+    def write_manifest(self, manifest: Dict[str, tuple]):
+        """
+
+        Stores the manifest of source files the archive was built from.
+
+        :param manifest: dict mapping filenames to (size, mtime, file_hash)
+        :return: None
+        """
+        files = sorted(manifest)
+        group = self.archive.create_group("_manifest")
+
+        _write_column(group, "file", files)
+        group.create_dataset(
+            "size", data=np.array([manifest[f][0] for f in files], dtype=np.int64)
+        )
+        group.create_dataset(
+            "mtime", data=np.array([manifest[f][1] for f in files], dtype=np.float64)
+        )
+        _write_column(group, "file_hash", [manifest[f][2] for f in files])
+
+    def add_batch(
+        self, label: str, images: List[np.ndarray], metadata: Dict[str, list]
+    ):
+        """
+
+        Adds images with the same label to the archive.
+
+        :param label: label of the images
+        :param images: list of images
+        :param metadata: dict mapping metadata keys (including "name") to lists of
+        values
+        :return: None
+        """
+        group = self.archive.require_group(label)
+        metadata = self._record_duplicates(metadata, len(images))
+
+        for i, img in enumerate(images):
+            name = metadata["name"][i]
+
+            if self.deduplicate and metadata["duplicate_of"][i] >= 0:
+                group[name] = self.first_occurrences[metadata["content_hash"][i]][1]
+                continue
+
+            dset = group.create_dataset(name, data=img)
+
+            for key, vals in metadata.items():
+                if key != "name":
+                    dset.attrs[key] = vals[i]
+
+            if self.deduplicate:
+                self.first_occurrences[metadata["content_hash"][i]] = (
+                    len(self.image_labels) + i,
+                    dset,
+                )
+
+        self.image_labels.extend([label] * len(images))
+
+        for key, vals in metadata.items():
+            self.metadata.setdefault(key, []).extend(vals)
+
+    def _record_duplicates(
+        self, metadata: Dict[str, list], n_images: int
+    ) -> Dict[str, list]:
+        """
+
+        Fills in the duplicate_of column of a batch, replacing any column passed through
+        from another archive. Duplicates within the batch point to their first
+        occurrence in the batch.
+
+        :param metadata: dict mapping metadata keys to lists of values
+        :param n_images: number of images in the batch
+        :return: metadata including the duplicate_of column
+        """
+        if not self.deduplicate:
+            return metadata
+
+        metadata = dict(metadata)
+        metadata["duplicate_of"] = []
+        seen = {}
+
+        for i, content_hash in enumerate(metadata["content_hash"]):
+            if content_hash in self.first_occurrences:
+                metadata["duplicate_of"].append(self.first_occurrences[content_hash][0])
+            elif content_hash in seen:
+                metadata["duplicate_of"].append(seen[content_hash])
+            else:
+                metadata["duplicate_of"].append(-1)
+                seen[content_hash] = len(self.image_labels) + i
+
+        return metadata
+
+    def add(self, label: str, img: np.ndarray, metadata: Dict):
+        """
+
+        Adds a single image to the archive.
+
+        :param label: label of the image
+        :param img: np.ndarray
+        :param metadata: dict mapping metadata keys (including "name") to values
+        :return: None
+        """
+        self.add_batch(label, [img], {key: [val] for key, val in metadata.items()})
+
+    def close(self):
+        table = self.archive.create_group("_metadata")
+        _write_column(table, "label", self.image_labels)
+
+        for key, vals in self.metadata.items():
+            _write_column(table, key, vals)
+
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RaggedArchiveWriter(GroupArchiveWriter):
+    """
+    Writes an archive in the "ragged" layout. Images have to be added grouped by label.
+    Pixels are buffered in memory and appended to the archive in large writes.
+
+    With deduplicate set, images whose content_hash metadata was already written point
+    to the pixels of the first occurrence.
+
+    """
+
+    def __init__(self, path: str, deduplicate: bool = False, flush_size: int = 2 ** 22):
+        self.archive = h5py.File(path, "w")
+        self.archive.attrs["layout"] = "ragged"
+        self.deduplicate = deduplicate
+        self.flush_size = flush_size
+
+        self.pixels = None  # created on the first flush, when the dtype is known
+        self.buffer = []
+        self.buffered = 0
+        self.stored = 0  # number of pixels written or buffered
+        self.offsets = []
+        self.shapes = []
+        self.image_labels = []
+        self.label_names = []
+        self.label_offsets = [0]
+        self.metadata = {}
+        self.first_occurrences = {}
+
+    def add_batch(
+        self, label: str, images: List[np.ndarray], metadata: Dict[str, list]
+    ):
+        if not self.label_names or self.label_names[-1] != label:
+            if label in self.label_names:
+                raise ValueError(
+                    f"Label {label} was already written. Images have to be added "
+                    f"grouped by label."
+                )
+            self.label_names.append(label)
+            self.label_offsets.append(self.label_offsets[-1])
+
+        metadata = self._record_duplicates(metadata, len(images))
+
+        for i, img in enumerate(images):
+            self.shapes.append(img.shape)
+
+            if self.deduplicate and metadata["duplicate_of"][i] >= 0:
+                self.offsets.append(
+                    self.first_occurrences[metadata["content_hash"][i]][1]
+                )
+                continue
+
+            if self.deduplicate:
+                self.first_occurrences[metadata["content_hash"][i]] = (
+                    len(self.image_labels) + i,
+                    self.stored,
+                )
+
+            self.offsets.append(self.stored)
+            self.buffer.append(np.ravel(img))
+            self.buffered += img.size
+            self.stored += img.size
+
+        self.image_labels.extend([label] * len(images))
+        self.label_offsets[-1] += len(images)
+
+        for key, vals in metadata.items():
+            self.metadata.setdefault(key, []).extend(vals)
+
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+
+        Appends the buffered pixels to the pixel buffer in the archive.
+
+        :return: None
+        """
+        if not self.buffer:
+            return
+
+        flat = np.concatenate(self.buffer)
+
+        if self.pixels is None:
+            self.pixels = self.archive.create_dataset(
+                "pixels",
+                shape=(0,),
+                maxshape=(None,),
+                dtype=flat.dtype,
+                chunks=(2 ** 16,),
+            )
+
+        start = self.pixels.shape[0]
+        self.pixels.resize((start + flat.size,))
+        self.pixels[start:] = flat
+
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+        if self.pixels is None:
+            self.archive.create_dataset("pixels", shape=(0,), dtype=np.uint8)
+
+        self.archive.create_dataset(
+            "offsets", data=np.array(self.offsets, dtype=np.int64)
+        )
+        # an archive without images still stores two-dimensional shapes
+        self.archive.create_dataset(
+            "shapes",
+            data=np.array(self.shapes, dtype=np.int32).reshape(len(self.shapes), -1)
+            if self.shapes
+            else np.zeros((0, 2), dtype=np.int32),
+        )
+        _write_column(self.archive, "label_names", self.label_names)
+        self.archive.create_dataset(
+            "label_offsets", data=np.array(self.label_offsets, dtype=np.int64)
+        )
+
+        metadata_group = self.archive.create_group("metadata")
+        for key, vals in self.metadata.items():
+            _write_column(metadata_group, key, vals)
+
+        self.archive.close()
+
+
+def open_archive(path: str) -> ArchiveReader:
+    """
+
+    Opens an image archive for reading, detecting its layout.
+
+    :param path: path to the HDF5 archive
+    :return: GroupArchiveReader or RaggedArchiveReader
+    """
+    with h5py.File(path, "r") as archive:
+        layout = archive.attrs.get("layout", "groups")
+
+    return RaggedArchiveReader(path) if layout == "ragged" else GroupArchiveReader(path)
+
+
+def create_archive(
+    path: str, layout: str = "groups", deduplicate: bool = False
+) -> GroupArchiveWriter:
+    """
+
+    Creates a new image archive.
+
+    :param path: path to the HDF5 archive
+    :param layout: one of LAYOUTS
+    :param deduplicate: store images with the same content_hash metadata only once
+    :return: GroupArchiveWriter or RaggedArchiveWriter
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown archive layout {layout}, expected one of {LAYOUTS}")
+
+    return (
+        RaggedArchiveWriter(path, deduplicate)
+        if layout == "ragged"
+        else GroupArchiveWriter(path, deduplicate)
+    )
@@ -0,0 +1,186 @@
+# content-addressed cache of transformed images, shared by all ProcessImageTask
+# subclasses
+#
+# Entries are keyed by a digest of the input image and the chain of transforms applied
+# to it, so a parameter sweep only computes the transforms that changed and reuses
+# everything upstream of them. Entries live in a single SQLite database, which several
+# worker processes can use at once. Once the stored images exceed the size budget, the
+# least recently used entries are evicted.
+#
+# The database runs in WAL mode, which relies on shared memory between the processes
+# using it and is unsafe on network filesystems such as NFS. Keep the cache folder on a
+# local disk, not next to the archives in hdffolder when that lives on a shared
+# filesystem.
+
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+from typing import Dict, List
+
+CACHE_FILE = "transforms.sqlite"
+
+
+def transform_key(input_key: str, transform: str, params: Dict[str, str]) -> str:
+    """
+
+    Derives the cache key of a transformed image from the key of its input and the
+    transform applied.
+
+    :param input_key: image hash of the input, or the key of the transform that produced
+    it
+    :param transform: name of the transform, i.e. the task family
+    :param params: parameters of the transform
+    :return: hex digest
+    """
+    digest = hashlib.sha1(f"{input_key}:{transform}".encode("utf-8"))
+
+    for param, value in sorted(params.items()):
+        digest.update(f":{param}={value}".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+class TransformCache:
+    """
+
+    Disk cache mapping keys to images, with a size budget and least recently used
+    eviction.
+
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        os.makedirs(folder, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(os.path.join(folder, CACHE_FILE), timeout=600)
+        # readers don't block the writer in other worker processes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS images "
+            "(key TEXT PRIMARY KEY, dtype TEXT, shape TEXT, pixels BLOB, "
+            "size INTEGER, last_used REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used)"
+        )
+        self.connection.commit()
+
+        # running total of the stored sizes, kept by triggers so every process sees the
+        # same one. Replaced rows only fire the delete trigger with recursive triggers
+        # on.
+        self.connection.execute("PRAGMA recursive_triggers=ON")
+        self.connection.executescript(
+            """
+            BEGIN IMMEDIATE; CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY
+            CHECK (id = 0), total INTEGER); INSERT OR IGNORE INTO usage SELECT 0,
+            COALESCE(SUM(size), 0) FROM images; CREATE TRIGGER IF NOT EXISTS
+            images_insert AFTER INSERT ON images
+                BEGIN UPDATE usage SET total = total + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS images_delete AFTER DELETE ON images
+                BEGIN UPDATE usage SET total = total - OLD.size; END;
+            COMMIT;
+            """
+        )
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+
+        Looks up images by key, marking hits as recently used.
+
+        :param keys: list of cache keys
+        :return: dict mapping the keys found to their images
+        """
+        found = {}
+
+        # stays below the SQLite limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self.connection.execute(
+                "SELECT key, dtype, shape, pixels FROM images WHERE key IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            )
+
+            for key, dtype, shape, pixels in rows:
+                found[key] = np.frombuffer(pixels, dtype=np.dtype(dtype)).reshape(
+                    [int(dim) for dim in shape.split(",") if dim]
+                )
+
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE images SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self.connection.commit()
+
+        return found
+
+    def put_many(self, images: Dict[str, np.ndarray]):
+        """
+
+        Stores images by key, then evicts the least recently used entries beyond the
+        size budget.
+
+        :param images: dict mapping cache keys to images
+        :return: None
+        """
+        if not images:
+            return
+
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    key,
+                    img.dtype.str,
+                    ",".join(str(dim) for dim in img.shape),
+                    np.ascontiguousarray(img).tobytes(),
+                    img.nbytes,
+                    now,
+                )
+                for key, img in images.items()
+            ],
+        )
+        self.connection.commit()
+
+        self.evict()
+
+    def evict(self):
+        """
+
+        Deletes the least recently used entries until the stored images fit the size
+        budget.
+
+        :return: None
+        """
+        (total,) = self.connection.execute("SELECT total FROM usage").fetchone()
+
+        if total <= self.max_bytes:
+            return
+
+        evicted = []
+
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM images ORDER BY last_used"
+        ):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+
+        self.connection.executemany("DELETE FROM images WHERE key = ?", evicted)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
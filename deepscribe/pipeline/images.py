@@ -1,17 +1,118 @@
 # luigi tasks for image processing
 #
 import cv2
+import hashlib
 import luigi
 import os
-import h5py
+import shutil
 from tqdm import tqdm
-from deepscribe.pipeline.aggregation import OchreToHD5Task
+from deepscribe.pipeline.aggregation import OchreToHD5Task, dataset_name
+from deepscribe.pipeline.archive import (
+    open_archive,
+    create_archive,
+    ArchiveReader,
+    previous_images,
+    replacing_path,
+    image_hash,
+    quantize,
+    dequantize,
+    LAYOUTS,
+    PRECISIONS,
+)
+from deepscribe.pipeline.cache import TransformCache, transform_key
 from sklearn.preprocessing import StandardScaler
 from skimage.util import random_noise
 from abc import ABC
 from scipy.ndimage import gaussian_filter
 import numpy as np
-from typing import List
+from contextlib import ExitStack
+from multiprocessing import Pool
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+
+def _shard_labels(
+    labels: List[str], counts: Dict[str, int], n_shards: int
+) -> List[List[str]]:
+    """
+
+    Splits labels into shards with similar numbers of images, largest labels first.
+
+    :param labels: list of labels
+    :param counts: number of images of each label
+    :param n_shards: maximum number of shards
+    :return: list of non-empty lists of labels
+    """
+
+    shards = [[] for _ in range(min(n_shards, len(labels)))]
+    sizes = [0] * len(shards)
+
+    for label in sorted(labels, key=lambda label: -counts[label]):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(label)
+        sizes[smallest] += counts[label]
+
+    return [shard for shard in shards if shard]
+
+
+def _chunk_labels(
+    labels: List[str], counts: Dict[str, int], max_images: int
+) -> List[List[str]]:
+    """
+
+    Splits labels into runs of consecutive labels holding about max_images images each.
+    Larger labels get a run of their own.
+
+    :param labels: list of labels, in order
+    :param counts: number of images of each label
+    :param max_images: number of images after which a run is closed
+    :return: list of non-empty lists of labels
+    """
+
+    chunks = [[]]
+    size = 0
+
+    for label in labels:
+        if chunks[-1] and size + counts[label] > max_images:
+            chunks.append([])
+            size = 0
+
+        chunks[-1].append(label)
+        size += counts[label]
+
+    return [chunk for chunk in chunks if chunk]
+
+
+def _process_part(job):
+    """
+
+    Rebuilds a ProcessImageTask in a worker process and processes one part of the
+    labels.
+
+    :param job: tuple of task class, task parameters, labels and part path
+    :return:
+    """
+
+    task_class, param_kwargs, labels, path = job
+    task_class(**param_kwargs).process_part(labels, path)
+
+
+def _is_checkpoint(path: str, stamp: str) -> bool:
+    """
+
+    Whether a checkpoint archive exists and was computed from the current source
+    archive.
+
+    :param path: path to the checkpoint archive
+    :param stamp: stamp of the source archive, or None
+    :return: bool
+    """
+
+    if not os.path.exists(path):
+        return False
+
+    with open_archive(path) as checkpoint:
+        return checkpoint.attrs.get("stamp") == stamp
 
 
 class ProcessImageTask(luigi.Task, ABC):
@@ -24,8 +125,78 @@ class ProcessImageTask(luigi.Task, ABC):
 
     imgfolder = luigi.Parameter()
     hdffolder = luigi.Parameter()
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups")
+    # precision of the stored images, see archive.quantize
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # only process images whose source changed since the existing output was written
+    incremental = luigi.BoolParameter(default=False, significant=False)
+    # apply the whole chain of processing tasks in one pass over the original archive,
+    # skipping intermediate archives
+    fused = luigi.BoolParameter(default=False, significant=False)
+    # number of processes, each handling a share of the labels. Does not change the
+    # output.
+    workers = luigi.IntParameter(default=1, significant=False)
+    # keep finished labels on disk, so a restarted run picks up where the last one
+    # stopped
+    checkpoint = luigi.BoolParameter(default=False, significant=False)
+    # number of images after which a checkpoint is written, several small labels share
+    # one
+    checkpoint_images = luigi.IntParameter(default=10000, significant=False)
+    # folder of the transform cache shared across tasks and parameter sweeps, and its
+    # size budget in MB. Keep it on a local disk, see cache.py
+    cache_dir = luigi.OptionalParameter(default=None, significant=False)
+    cache_size = luigi.IntParameter(default=4096, significant=False)
     identifier = ""  # to be set to describe image transformation
 
+    def source(self):
+        """
+
+        The task producing the archive this task transforms.
+
+        :return: luigi.Task, either OchreToHD5Task or another ProcessImageTask
+        """
+        raise NotImplementedError
+
+    def chain(self) -> Tuple[luigi.Task, List["ProcessImageTask"]]:
+        """
+
+        Walks the processing chain back to the task producing the original archive.
+
+        :return: the task producing the original archive, and the processing tasks from
+        there up to this one
+        """
+
+        stages = [self]
+        upstream = self.source()
+
+        while isinstance(upstream, ProcessImageTask):
+            stages.insert(0, upstream)
+            upstream = upstream.source()
+
+        return upstream, stages
+
+    def requires(self):
+        """
+
+        Requires the source archive, or in fused mode the original archive at the start
+        of the processing chain.
+
+        :return: luigi.Task
+        """
+
+        return self.chain()[0] if self.fused else self.source()
+
+    def stages(self):
+        """
+
+        The processing tasks applied by this task in order, only itself unless in fused
+        mode.
+
+        :return: list of ProcessImageTask
+        """
+
+        return self.chain()[1] if self.fused else [self]
+
     def process_image(self, img):
         """
 
@@ -36,34 +207,374 @@ class ProcessImageTask(luigi.Task, ABC):
         """
         raise NotImplementedError
 
+    def process_batch(self, images):
+        """
+
+        Maps a list of images to a list of transformed float32 images.
+
+        Falls back to calling process_image on each image. Subclasses can override this
+        with a vectorized implementation.
+
+        :param images: list of np.ndarray
+        :return: list of np.ndarray
+        """
+
+        # casting to float32
+        return [self.process_image(img).astype(np.float32) for img in images]
+
+    def complete(self):
+        """
+
+        In incremental mode, the output is only complete if the whole upstream chain is
+        complete and the output was computed from the current set of source images.
+
+        :return: bool
+        """
+
+        if not self.incremental:
+            return super().complete()
+
+        # an upstream change has to propagate, even though this output exists
+        if not all(task.complete() for task in luigi.task.flatten(self.requires())):
+            return False
+
+        if not self.output().exists():
+            return False
+
+        with open_archive(self.input().path) as original_archive, open_archive(
+            self.output().path
+        ) as processed_archive:
+            stamp = original_archive.attrs.get("stamp")
+            return stamp is not None and processed_archive.attrs.get("stamp") == stamp
+
     def run(self):
         """
 
-        Runs the process_image function on every image in the HDF5 archive, keeping the archive structure constant.
+        Runs the process_batch function on the images of every label in the HDF5
+        archive, keeping the archive structure constant.
+
+        In fused mode, the process_batch functions of every stage are applied in turn,
+        so only the final archive is written.
+
+        In incremental mode, processed images are reused from the existing output if
+        their name and source file hash did not change.
+
+        With more than one worker, labels are sharded across a process pool. Every
+        worker writes its labels to a shard archive, and the shards are merged into the
+        output in the original label order.
+
+        With checkpointing, labels are processed in runs of about checkpoint_images
+        images, every finished run is kept in the checkpoint folder next to the output,
+        and a restarted run only processes the remaining runs before merging.
+
+        :return:
+        """
+
+        with open_archive(self.input().path) as original_archive:
+            labels = original_archive.labels()
+            counts = {label: original_archive.count(label) for label in labels}
+            stamp = original_archive.attrs.get("stamp")
+            deduplicate = "duplicate_of" in original_archive.metadata
+
+        # an existing archive is replaced atomically
+        with (
+            replacing_path(self.output())
+            if self.incremental and self.output().exists()
+            else self.output().temporary_path()
+        ) as self.temp_output_path:
+            if self.checkpoint:
+                os.makedirs(self.checkpoint_folder(), exist_ok=True)
+                chunks = [
+                    (chunk, self.checkpoint_path(chunk))
+                    for chunk in _chunk_labels(labels, counts, self.checkpoint_images)
+                ]
+                parts = {label: path for chunk, path in chunks for label in chunk}
+                jobs = [
+                    (chunk, path)
+                    for chunk, path in chunks
+                    if not _is_checkpoint(path, stamp)
+                ]
+            elif self.workers > 1 and len(labels) > 1:
+                jobs = [
+                    (shard, "{}.shard{}".format(self.temp_output_path, i))
+                    for i, shard in enumerate(
+                        _shard_labels(labels, counts, self.workers)
+                    )
+                ]
+                parts = {label: path for shard, path in jobs for label in shard}
+            else:
+                jobs = None
+                self.process_labels(labels, self.temp_output_path)
+
+            if jobs is not None:
+                try:
+                    if self.workers > 1 and len(jobs) > 1:
+                        with Pool(min(self.workers, len(jobs))) as pool:
+                            pool.map(
+                                _process_part,
+                                [
+                                    (type(self), self.param_kwargs, job_labels, path)
+                                    for job_labels, path in jobs
+                                ],
+                                chunksize=1,
+                            )
+                    else:
+                        for job_labels, path in jobs:
+                            self.process_part(job_labels, path)
+
+                    self.merge_parts(labels, parts, stamp, deduplicate)
+                finally:
+                    # checkpoints outlive a failed run, shards don't
+                    if not self.checkpoint:
+                        for _, path in jobs:
+                            if os.path.exists(path):
+                                os.remove(path)
+
+        if self.checkpoint:
+            shutil.rmtree(self.checkpoint_folder())
+
+    def checkpoint_folder(self) -> str:
+        """
+
+        Folder holding the archives of finished runs of labels while checkpointing.
+
+        :return: path to folder
+        """
+
+        return "{}.checkpoint".format(self.output().path)
+
+    def checkpoint_path(self, labels: List[str]) -> str:
+        """
+
+        Location of the checkpoint archive of a run of labels, named by a hash of the
+        labels, since signs aren't valid file names.
+
+        :param labels: labels of the source archive
+        :return: path to archive
+        """
+
+        digest = hashlib.sha1("\n".join(labels).encode("utf-8")).hexdigest()
+        return "{}/{}.h5".format(self.checkpoint_folder(), digest)
+
+    def process_part(self, labels: List[str], path: str):
+        """
+
+        Processes the images of the given labels into a separate archive, which only
+        appears at path once complete.
 
+        :param labels: labels of the source archive to process
+        :param path: path of the new archive
         :return:
         """
 
-        with self.output().temporary_path() as self.temp_output_path:
-            new_archive = h5py.File(self.temp_output_path, "w")
+        partial_path = "{}.partial".format(path)
+        self.process_labels(labels, partial_path)
+        os.replace(partial_path, path)
+
+    def merge_parts(
+        self, labels: List[str], parts: Dict[str, str], stamp: str, deduplicate: bool
+    ):
+        """
+
+        Merges the archives of processed labels into the temporary output, in the
+        original label order.
+
+        :param labels: labels of the source archive
+        :param parts: path of the archive holding each label
+        :param stamp: stamp of the source archive, or None
+        :param deduplicate: whether to store identical images once
+        :return:
+        """
+
+        part_archives = {path: open_archive(path) for path in set(parts.values())}
+
+        new_archive = create_archive(
+            self.temp_output_path, self.layout, deduplicate=deduplicate
+        )
+
+        for label in tqdm(labels, desc="Merging labels"):
+            new_archive.add_batch(label, *part_archives[parts[label]].read_label(label))
+
+        if stamp is not None:
+            new_archive.attrs["stamp"] = stamp
+
+        new_archive.close()
+
+        for part_archive in part_archives.values():
+            part_archive.close()
+
+    def process_labels(self, labels: List[str], path: str):
+        """
+
+        Processes the images of the given labels into a new archive.
+
+        :param labels: labels of the source archive to process
+        :param path: path of the new archive
+        :return:
+        """
+
+        previous = (
+            open_archive(self.output().path)
+            if self.incremental and self.output().exists()
+            else None
+        )
+
+        original_archive = open_archive(self.input().path)
+
+        # duplicates of the input are processed once and stored once
+        duplicate_of = original_archive.metadata.get("duplicate_of", [])
+        referenced = {int(i) for i in duplicate_of if i >= 0}
+        processed_originals = {}
+        stages = self.stages()
+        cache = (
+            TransformCache(self.cache_dir, self.cache_size * 2 ** 20)
+            if self.cache_dir
+            else None
+        )
+
+        new_archive = create_archive(path, self.layout, deduplicate=bool(referenced))
+
+        for label in tqdm(labels, desc="Processing labels"):
+            # the whole label is read at once, in a single read for ragged archives
+            images, metadata = original_archive.read_label(label)
+            images = dequantize(images, metadata)
+
+            reusable = previous_images(previous, label)
+            file_hashes = metadata.get("file_hash", [None] * len(images))
+            rows = original_archive.label_rows[label]
+
+            # originals processed so far or in this batch. Originals in labels handled
+            # elsewhere are recomputed.
+            available = set(processed_originals) | {int(index) for index in rows}
+
+            processed_imgs = [None] * len(images)
+            pending = []
+
+            for position, (index, name, file_hash) in enumerate(
+                zip(rows, metadata["name"], file_hashes)
+            ):
+                if referenced and int(duplicate_of[index]) in available:
+                    # resolved below, once the original has been processed
+                    continue
+                elif (name, file_hash) in reusable:
+                    processed_imgs[position] = reusable[(name, file_hash)][0]
+                else:
+                    pending.append(position)
+
+            # the images left to process go through process_batch together
+            batch = self.apply_stages(
+                stages, [images[position] for position in pending], cache
+            )
+
+            for position, processed_img in zip(pending, batch):
+                processed_imgs[position] = processed_img
+
+            for position, index in enumerate(rows):
+                if index in referenced:
+                    processed_originals[int(index)] = processed_imgs[position]
+                elif processed_imgs[position] is None:
+                    processed_imgs[position] = processed_originals[
+                        int(duplicate_of[index])
+                    ]
+
+            new_archive.add_batch(
+                label, *quantize(processed_imgs, metadata, self.precision)
+            )
+
+        # processed archives are identified by the source images they were computed from
+        if "stamp" in original_archive.attrs:
+            new_archive.attrs["stamp"] = original_archive.attrs["stamp"]
+
+        new_archive.close()
+        original_archive.close()
+
+        if previous is not None:
+            previous.close()
+
+        if cache is not None:
+            cache.close()
+
+    def transform_params(self) -> Dict[str, str]:
+        """
+
+        The significant parameters describing the transformation itself, leaving out
+        locations and storage layout.
+
+        :return: dict mapping parameter names to values as str
+        """
+
+        return {
+            param: str(self.__getattribute__(param))
+            for param, obj in self.get_params()
+            if obj.significant
+            and param not in ["hdffolder", "imgfolder", "layout", "precision"]
+        }
+
+    def apply_stages(
+        self, stages: List["ProcessImageTask"], images: List[np.ndarray], cache=None
+    ) -> List[np.ndarray]:
+        """
+
+        Applies the process_batch functions of a chain of stages to a list of images.
+
+        With a cache, every image starts from the output of the last stage found in the
+        cache, and the outputs of the stages computed are added to it.
+
+        :param stages: list of ProcessImageTask, in order of application
+        :param images: list of np.ndarray
+        :param cache: TransformCache or None
+        :return: list of np.ndarray
+        """
+
+        if cache is None:
+            for stage in stages:
+                images = stage.process_batch(images)
+
+            return images
+
+        # chain of cache keys of every image, one list per stage
+        keys = [image_hash(img) for img in images]
+        chain = []
+
+        for stage in stages:
+            keys = [
+                transform_key(key, stage.get_task_family(), stage.transform_params())
+                for key in keys
+            ]
+            chain.append(keys)
 
-            original_archive = h5py.File(self.input().path, "r")
+        images = list(images)
+        # index of the first stage left to compute for each image
+        first_stage = [0] * len(images)
+        uncached = list(range(len(images)))
 
-            for label in tqdm(original_archive.keys(), desc="Processing labels"):
-                group = new_archive.require_group(label)
+        for stage_index in reversed(range(len(stages))):
+            if not uncached:
+                break
 
-                for img in original_archive[label].keys():
-                    npy_img = np.array(original_archive[label][img])
-                    # casting to float32
-                    processed_img = self.process_image(npy_img).astype(np.float32)
+            found = cache.get_many([chain[stage_index][i] for i in uncached])
 
-                    new_dset = group.create_dataset(img, data=processed_img)
+            for i in uncached:
+                if chain[stage_index][i] in found:
+                    images[i] = found[chain[stage_index][i]]
+                    first_stage[i] = stage_index + 1
 
-                    for key, val in original_archive[label][img].attrs.items():
-                        new_dset.attrs[key] = val
+            uncached = [i for i in uncached if first_stage[i] == 0]
 
-            new_archive.close()
-            original_archive.close()
+        for stage_index, stage in enumerate(stages):
+            pending = [i for i in range(len(images)) if first_stage[i] <= stage_index]
+
+            if not pending:
+                continue
+
+            processed = stage.process_batch([images[i] for i in pending])
+
+            for i, processed_img in zip(pending, processed):
+                images[i] = processed_img
+
+            cache.put_many({chain[stage_index][i]: images[i] for i in pending})
+
+        return images
 
     def output(self):
         """
@@ -75,26 +586,93 @@ class ProcessImageTask(luigi.Task, ABC):
 
         # append the rest of the parameter values
 
-        additional_params = [
-            param
-            for param, obj in self.get_params()
-            if param not in ["hdffolder", "imgfolder"]
-        ]
-
-        additional_param_vals = [
-            str(self.__getattribute__(param)) for param in additional_params
-        ]
+        additional_param_vals = list(self.transform_params().values())
 
         return luigi.LocalTarget(
-            "{}/{}_{}_{}.h5".format(
+            "{}/{}_{}_{}{}{}.h5".format(
                 self.hdffolder,
-                os.path.basename(self.imgfolder),
+                dataset_name(self.imgfolder),
                 self.identifier,
                 "_".join(additional_param_vals),
+                f"_{self.precision}" if self.precision != "float32" else "",
+                "_ragged" if self.layout == "ragged" else "",
             )
         )
 
 
+class ProcessedArchiveView(ArchiveReader):
+    """
+    Read-only view of the output of a ProcessImageTask, computed on the fly from the
+    original archive.
+
+    Applies the whole processing chain of the task when images are read, without writing
+    any intermediate archive, and keeps recently read images in memory. Offers the same
+    interface as the archive readers.
+
+    """
+
+    def __init__(self, task: ProcessImageTask, max_bytes: int = 2 ** 30):
+        original, self.stages = task.chain()
+        self.source = open_archive(original.output().path)
+        self.archive = self.source.archive
+        self.metadata = self.source.metadata
+        self.image_labels = self.source.image_labels
+        self.label_rows = self.source.label_rows
+
+        # processed images by index of their first occurrence, least recently used first
+        self.max_bytes = max_bytes
+        self.cached = OrderedDict()
+        self.cached_bytes = 0
+
+    def _read_rows(self, indices: np.ndarray) -> List[np.ndarray]:
+        """
+
+        Reads the images with the given indices, processing those not in the cache.
+
+        :param indices: array of image indices
+        :return: list of processed images
+        """
+
+        # duplicates share the processed image of their first occurrence
+        duplicate_of = self.metadata.get("duplicate_of")
+        keys = [
+            int(duplicate_of[i])
+            if duplicate_of is not None and duplicate_of[i] >= 0
+            else int(i)
+            for i in indices
+        ]
+
+        missing = sorted({key for key in keys if key not in self.cached})
+
+        if missing:
+            images = self.source._read_rows(np.array(missing, dtype=np.int64))
+
+            for stage in self.stages:
+                images = stage.process_batch(images)
+
+            for key, img in zip(missing, images):
+                self.cached[key] = img
+                self.cached_bytes += img.nbytes
+
+        processed = []
+
+        for key in keys:
+            self.cached.move_to_end(key)
+            processed.append(self.cached[key])
+
+        # evicting only after collecting, so a read larger than the cache still succeeds
+        while self.cached_bytes > self.max_bytes and self.cached:
+            _, img = self.cached.popitem(last=False)
+            self.cached_bytes -= img.nbytes
+
+        return processed
+
+    def close(self):
+        self.source.close()
+        self.cached.clear()
+        self.cached_bytes = 0
+
+
 # subtracting out the mean brightness
 class RescaleImageValuesTask(ProcessImageTask):
     """
@@ -108,14 +686,19 @@ class RescaleImageValuesTask(ProcessImageTask):
     hdffolder = luigi.Parameter()
     identifier = "rescaled"
 
-    def requires(self):
+    def source(self):
 
         """
 
         :return: OchreToHD5Task, required
         """
 
-        return OchreToHD5Task(self.imgfolder, self.hdffolder)
+        return OchreToHD5Task(
+            self.imgfolder,
+            self.hdffolder,
+            layout=self.layout,
+            incremental=self.incremental,
+        )
 
     def process_image(self, img):
         """
@@ -130,6 +713,32 @@ class RescaleImageValuesTask(ProcessImageTask):
 
         return scaled - np.mean(scaled)
 
+    def process_batch(self, images):
+        """
+
+        Rescales images of the same shape together, with one broadcasted mean
+        subtraction per group.
+
+        :param images: list of np.ndarray
+        :return: list of np.ndarray
+        """
+
+        rescaled = [None] * len(images)
+        shape_groups = {}
+
+        for position, img in enumerate(images):
+            shape_groups.setdefault(img.shape, []).append(position)
+
+        for positions in shape_groups.values():
+            scaled = np.stack([images[position] for position in positions]) / 255.0
+            image_axes = tuple(range(1, scaled.ndim))
+            scaled -= np.mean(scaled, axis=image_axes, keepdims=True)
+
+            for position, img in zip(positions, scaled.astype(np.float32)):
+                rescaled[position] = img
+
+        return rescaled
+
 
 class ThresholdImageTask(ProcessImageTask):
     """
@@ -143,13 +752,18 @@ class ThresholdImageTask(ProcessImageTask):
     # optional, if not using this set it to zero
     identifier = "thresholded"
 
-    def requires(self):
+    def source(self):
         """
 
 
         :return: OchreToHD5Task, required
         """
-        return OchreToHD5Task(self.imgfolder, self.hdffolder)
+        return OchreToHD5Task(
+            self.imgfolder,
+            self.hdffolder,
+            layout=self.layout,
+            incremental=self.incremental,
+        )
 
     def process_image(self, img):
         """
@@ -180,19 +794,30 @@ class StandardizeImageSizeTask(ProcessImageTask):
     threshold = luigi.BoolParameter(default=False)
     identifier = "resized"
 
-    def requires(self):
+    def source(self):
         """
 
-        Switches task graph construction depending on self.threshold argument.
-
+        Switches task graph construction depending on self.threshold argument. The
+        intermediate archive stays float32, so only the output is quantized, once, as in
+        fused mode.
 
         :return: luigi.Task, either ThresholdImageTask or RescaleImageValuesTask
         """
 
         if self.threshold:
-            return ThresholdImageTask(self.imgfolder, self.hdffolder)
+            return ThresholdImageTask(
+                imgfolder=self.imgfolder,
+                hdffolder=self.hdffolder,
+                layout=self.layout,
+                incremental=self.incremental,
+            )
         else:
-            return RescaleImageValuesTask(self.imgfolder, self.hdffolder)
+            return RescaleImageValuesTask(
+                imgfolder=self.imgfolder,
+                hdffolder=self.hdffolder,
+                layout=self.layout,
+                incremental=self.incremental,
+            )
 
     def process_image(self, img):
 
@@ -232,3 +857,176 @@ class StandardizeImageSizeTask(ProcessImageTask):
         )
 
         return new_im
+
+
+class MultiResolutionTask(luigi.Task):
+    """
+    Writes the outputs of StandardizeImageSizeTask for several target sizes in a single
+    pass over the source archive.
+
+    """
+
+    imgfolder = luigi.Parameter()
+    hdffolder = luigi.Parameter()
+    target_sizes = luigi.ListParameter()  # standardizing to square images of each size
+    sigma = luigi.FloatParameter(default=0.0)
+    threshold = luigi.BoolParameter(default=False)
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups")
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # run the rescaling or thresholding once for all sizes instead of reading its
+    # archive, see ProcessImageTask
+    fused = luigi.BoolParameter(default=False, significant=False)
+
+    def size_tasks(self) -> Dict[int, StandardizeImageSizeTask]:
+        """
+
+        The StandardizeImageSizeTask of every target size, whose outputs this task
+        writes.
+
+        :return: dict mapping target sizes to StandardizeImageSizeTask
+        """
+
+        return {
+            size: StandardizeImageSizeTask(
+                imgfolder=self.imgfolder,
+                hdffolder=self.hdffolder,
+                target_size=size,
+                sigma=self.sigma,
+                threshold=self.threshold,
+                layout=self.layout,
+                precision=self.precision,
+                fused=self.fused,
+            )
+            for size in self.target_sizes
+        }
+
+    def requires(self):
+        """
+
+        All sizes share the same source archive.
+
+        :return: luigi.Task, the requirement of the StandardizeImageSizeTask of the
+        first size
+        """
+
+        return self.size_tasks()[self.target_sizes[0]].requires()
+
+    def run(self):
+        """
+
+        Reads every label of the source archive once and writes the resized images of
+        every size.
+
+        Each size is resized from the source rather than from the next larger size, so
+        the outputs are the same as those of separate StandardizeImageSizeTask runs.
+        Sizes whose outputs already exist are left alone.
+
+        :return:
+        """
+
+        size_tasks = {
+            size: task
+            for size, task in self.size_tasks().items()
+            if not task.output().exists()
+        }
+
+        if not size_tasks:
+            return
+
+        first_task = next(iter(size_tasks.values()))
+        # in fused mode, the stages before resizing run once for all sizes
+        upstream_stages = first_task.stages()[:-1]
+
+        with open_archive(self.input().path) as original_archive, ExitStack() as stack:
+            deduplicate = "duplicate_of" in original_archive.metadata
+
+            new_archives = {
+                size: create_archive(
+                    stack.enter_context(task.output().temporary_path()),
+                    self.layout,
+                    deduplicate=deduplicate,
+                )
+                for size, task in size_tasks.items()
+            }
+
+            for label in tqdm(original_archive.labels(), desc="Processing labels"):
+                images, metadata = original_archive.read_label(label)
+                images = first_task.apply_stages(
+                    upstream_stages, dequantize(images, metadata)
+                )
+
+                for size, task in size_tasks.items():
+                    new_archives[size].add_batch(
+                        label,
+                        *quantize(task.process_batch(images), metadata, self.precision),
+                    )
+
+            for new_archive in new_archives.values():
+                if "stamp" in original_archive.attrs:
+                    new_archive.attrs["stamp"] = original_archive.attrs["stamp"]
+
+                new_archive.close()
+
+    def output(self):
+        """
+
+        The archives of StandardizeImageSizeTask for each target size.
+
+        :return: dict mapping target sizes to luigi.LocalTarget
+        """
+
+        return {size: task.output() for size, task in self.size_tasks().items()}
+
+
+class PreprocessedImagesMixin:
+    """
+    Shared by the tasks reading the output of StandardizeImageSizeTask, from its archive
+    or, in lazy mode, processed on the fly from the original archive. Expects the
+    imgfolder, hdffolder, target_size, sigma, threshold, layout, precision, fused and
+    lazy parameters.
+
+    """
+
+    def preprocessing(self) -> StandardizeImageSizeTask:
+        """
+
+        The task producing the preprocessed images.
+
+        :return: StandardizeImageSizeTask
+        """
+
+        return StandardizeImageSizeTask(
+            imgfolder=self.imgfolder,
+            hdffolder=self.hdffolder,
+            target_size=self.target_size,
+            sigma=self.sigma,
+            threshold=self.threshold,
+            layout=self.layout,
+            precision=self.precision,
+            fused=self.fused,
+        )
+
+    def preprocessed_requirement(self) -> luigi.Task:
+        """
+
+        :return: StandardizeImageSizeTask, or OchreToHD5Task when preprocessing lazily
+        """
+
+        if self.lazy:
+            return self.preprocessing().chain()[0]
+
+        return self.preprocessing()
+
+    def open_preprocessed(self, path: str) -> ArchiveReader:
+        """
+
+        Opens the preprocessed images.
+
+        :param path: path of the output of preprocessed_requirement
+        :return: archive reader, or ProcessedArchiveView when preprocessing lazily
+        """
+
+        if self.lazy:
+            return ProcessedArchiveView(self.preprocessing())
+
+        return open_archive(path)
@@ -0,0 +1,199 @@
+# sharded TFRecord storage of selected datasets
+#
+# Each split is written as a number of TFRecord shards of consecutive examples. An
+# example holds the raw bytes of the image in the storage precision, its label and image
+# uuid, and for uint8 images the scale and offset to undo quantization. The image shape
+# and dtype are stored once per folder in a JSON spec. Training streams and interleaves
+# the shards, so a split never has to fit in host memory.
+
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from typing import Dict, List
+
+SPEC_FILE = "records.json"
+SHARD_NAME = "{split}-{shard:05d}-of-{n_shards:05d}.tfrecord"
+
+
+def _bytes_feature(value: bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value: int) -> tf.train.Feature:
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _float_feature(value: float) -> tf.train.Feature:
+    return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+
+def write_records(
+    folder: str, split: str, arrays: Dict[str, np.ndarray], n_shards: int
+) -> int:
+    """
+
+    Writes one split of a selected dataset as TFRecord shards of consecutive examples.
+
+    :param folder: output folder
+    :param split: "train", "valid" or "test"
+    :param arrays: arrays of the split as saved by SelectDatasetTask, {split}_imgs,
+    {split}_labels and {split}_uuids, and {split}_scale and {split}_offset for uint8
+    images
+    :param n_shards: number of shards, lowered for splits with fewer images
+    :return: number of shards written
+    """
+    images = arrays[f"{split}_imgs"]
+    labels = arrays[f"{split}_labels"]
+    uuids = arrays[f"{split}_uuids"]
+    quantized = f"{split}_scale" in arrays
+
+    n_shards = max(1, min(n_shards, len(images)))
+    bounds = np.linspace(0, len(images), n_shards + 1).astype(int)
+
+    for shard in range(n_shards):
+        shard_path = os.path.join(
+            folder, SHARD_NAME.format(split=split, shard=shard, n_shards=n_shards)
+        )
+
+        with tf.io.TFRecordWriter(shard_path) as writer:
+            for i in range(bounds[shard], bounds[shard + 1]):
+                features = {
+                    "image": _bytes_feature(np.ascontiguousarray(images[i]).tobytes()),
+                    "label": _int64_feature(int(labels[i])),
+                    "uuid": _bytes_feature(str(uuids[i]).encode("utf-8")),
+                }
+
+                if quantized:
+                    features["scale"] = _float_feature(arrays[f"{split}_scale"][i])
+                    features["offset"] = _float_feature(arrays[f"{split}_offset"][i])
+
+                writer.write(
+                    tf.train.Example(
+                        features=tf.train.Features(feature=features)
+                    ).SerializeToString()
+                )
+
+    return n_shards
+
+
+def write_spec(folder: str, image_shape: tuple, dtype: str, n_images: Dict[str, int]):
+    """
+
+    Writes the JSON spec shared by the shards of a folder.
+
+    :param folder: output folder
+    :param image_shape: shape of a single image
+    :param dtype: storage dtype of the images
+    :param n_images: number of images per split
+    :return: None
+    """
+    with open(os.path.join(folder, SPEC_FILE), "w") as outf:
+        json.dump(
+            {"image_shape": list(image_shape), "dtype": dtype, "n_images": n_images},
+            outf,
+        )
+
+
+def read_spec(folder: str) -> Dict:
+    """
+
+    :param folder: folder of TFRecord shards
+    :return: dict with the image shape, the storage dtype and the number of images per
+    split
+    """
+    with open(os.path.join(folder, SPEC_FILE), "r") as inf:
+        return json.load(inf)
+
+
+def is_records_folder(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, SPEC_FILE))
+
+
+def record_files(folder: str, split: str) -> List[str]:
+    """
+
+    :param folder: folder of TFRecord shards
+    :param split: "train", "valid" or "test"
+    :return: sorted paths of the shards of the split
+    """
+    return sorted(
+        os.path.join(folder, file)
+        for file in os.listdir(folder)
+        if file.startswith(f"{split}-") and file.endswith(".tfrecord")
+    )
+
+
+def parse_record(spec: Dict):
+    """
+
+    Builds the function parsing a serialized example into a float32 image and its label.
+
+    :param spec: spec of the folder, see read_spec
+    :return: function mapping a serialized example to (image, label)
+    """
+    features = {
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    }
+    quantized = spec["dtype"] == "uint8"
+
+    if quantized:
+        features["scale"] = tf.io.FixedLenFeature([], tf.float32)
+        features["offset"] = tf.io.FixedLenFeature([], tf.float32)
+
+    def parse(serialized):
+        example = tf.io.parse_single_example(serialized, features)
+        image = tf.reshape(
+            tf.io.decode_raw(example["image"], tf.dtypes.as_dtype(spec["dtype"])),
+            spec["image_shape"],
+        )
+        image = tf.cast(image, tf.float32)
+
+        if quantized:
+            image = image * example["scale"] + example["offset"]
+
+        return image, example["label"]
+
+    return parse
+
+
+def records_dataset(
+    folder: str,
+    split: str,
+    interleave: bool = False,
+    cycle_length: int = 4,
+    seed: int = None,
+) -> tf.data.Dataset:
+    """
+
+    Streams one split of a folder of TFRecord shards as (image, label) pairs of float32
+    images.
+
+    :param folder: folder of TFRecord shards
+    :param split: "train", "valid" or "test"
+    :param interleave: read cycle_length shards in parallel, in shuffled order.
+    Otherwise the examples are read in the order they were written.
+    :param cycle_length: number of shards read at once when interleaving
+    :param seed: seed of the shard order when interleaving
+    :return: tf.data.Dataset
+    """
+    files = record_files(folder, split)
+
+    if interleave:
+        dataset = (
+            tf.data.Dataset.from_tensor_slices(files)
+            .shuffle(len(files), seed=seed)
+            .interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=cycle_length,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            )
+        )
+    else:
+        dataset = tf.data.TFRecordDataset(files)
+
+    return dataset.map(
+        parse_record(read_spec(folder)),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    )
@@ -1,17 +1,272 @@
 # processing images for input to TensorFlow
 
+import hashlib
 import luigi
 import os
 from tqdm import tqdm
-import h5py
-from deepscribe.pipeline.images import StandardizeImageSizeTask
+from deepscribe.pipeline.images import PreprocessedImagesMixin
+from deepscribe.pipeline.aggregation import dataset_name
+from deepscribe.pipeline.archive import (
+    open_archive,
+    image_hash,
+    quantize,
+    dequantize,
+    LAYOUTS,
+    PRECISIONS,
+)
 from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import train_test_split
 import numpy as np
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
+import tensorflow as tf
+from deepscribe.pipeline.whitening import ZCAWhitening, FitWhiteningTask
+from deepscribe.pipeline.shards import LabelShardsTask, LabelShardsReader
+from deepscribe.pipeline.records import (
+    write_records,
+    write_spec,
+    read_spec,
+    is_records_folder,
+    records_dataset,
+)
+from typing import Dict, Optional, Tuple
+
+
+def quantize_split(
+    split: str, images: np.ndarray, precision: str
+) -> Dict[str, np.ndarray]:
+    """
+
+    Converts the images of one split to the storage precision, see archive.quantize.
+
+    :param split: "train", "valid" or "test"
+    :param images: array of float images
+    :param precision: one of PRECISIONS
+    :return: dict of arrays to save, the images and for uint8 their scale and offset
+    """
+
+    if precision != "uint8":
+        return {f"{split}_imgs": images.astype(precision, copy=False)}
+
+    quantized, metadata = quantize(list(images), {}, precision)
+
+    return {
+        # an empty split keeps the image dimensions
+        f"{split}_imgs": np.array(quantized, dtype=np.uint8).reshape(images.shape),
+        f"{split}_scale": np.array(metadata["scale"], dtype=np.float32),
+        f"{split}_offset": np.array(metadata["offset"], dtype=np.float32),
+    }
+
+
+def load_selection(path: str) -> Dict[str, np.ndarray]:
+    """
+
+    Opens the output of SelectDatasetTask. The arrays of a folder of NPY files are
+    memory-mapped, so they are read on access and shared between processes on the same
+    node. For a folder of TFRecord shards, only the classes and labels are loaded, and
+    "records" holds the path of the folder.
+
+    :param path: path of the NPZ archive, NPY folder or TFRecord folder
+    :return: dict-like mapping array names to arrays
+    """
+
+    if os.path.isdir(path):
+        data = {
+            os.path.splitext(file)[0]: np.load(os.path.join(path, file), mmap_mode="r")
+            for file in os.listdir(path)
+            if file.endswith(".npy")
+        }
+
+        if is_records_folder(path):
+            data["records"] = np.array(path)
+
+        return data
+
+    return np.load(path)
+
+
+def selection_name(path: str) -> str:
+    """
+
+    Name identifying a selected dataset in the names of derived outputs. Folder outputs
+    keep their whole name, since their sigma contains a dot that Path.stem would cut at.
+
+    :param path: path of the NPZ archive, NPY folder or TFRecord folder
+    :return: file or folder name without the .npz extension
+    """
+
+    name = os.path.basename(os.path.normpath(path))
+
+    return name[: -len(".npz")] if name.endswith(".npz") else name
+
+
+def selection_stamp(path: str) -> str:
+    """
+
+    Digest identifying the contents of a selected dataset, from its name, the number of
+    images of each split, the stamp of the archive index output points into and the time
+    it was written. A selection made again under the same name gets a new stamp.
+
+    :param path: path of the NPZ archive, NPY folder or TFRecord folder
+    :return: hex digest
+    """
+
+    data = load_selection(path)
+    digest = hashlib.sha1(selection_name(path).encode("utf-8"))
+
+    for split in ["train", "valid", "test"]:
+        digest.update(f":{split}={len(data[f'{split}_labels'])}".encode("utf-8"))
+
+    if "archive_stamp" in data:
+        digest.update(f":{data['archive_stamp']}".encode("utf-8"))
+
+    digest.update(f":{os.stat(path).st_mtime_ns}".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def load_stored_images(
+    data, split: str
+) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+
+    Reads the images of one split of a selected dataset in their storage precision,
+    without undoing quantization. For index output, the images are gathered from the
+    preprocessed archive. Arrays of a folder of NPY files stay memory-mapped.
+
+    :param data: output of SelectDatasetTask opened with load_selection, other than
+    TFRecord output
+    :param split: "train", "valid" or "test"
+    :return: array of images, and the per-image scale and offset of uint8 images, or
+    None
+    """
+
+    if f"{split}_indices" in data:
+        indices = data[f"{split}_indices"]
+        # reading in archive order, which is contiguous for ragged archives
+        order = np.argsort(indices)
+
+        with open_archive(str(data["archive"])) as archive:
+            # incremental runs rewrite the archive in place, moving the rows the
+            # indices point to
+            stamp = str(data["archive_stamp"]) if "archive_stamp" in data else None
+
+            if archive.attrs.get("stamp", "") != stamp:
+                raise ValueError(
+                    f"{data['archive']} doesn't hold the source images the selection "
+                    f"was made from. It was rebuilt since, or the selection predates "
+                    f"archive stamps. Run the selection again."
+                )
+
+            gathered, metadata = archive.read_indices(indices[order])
+            # an empty split still takes the image shape and dtype of the archive
+            sample = (
+                gathered[:1] or archive.read_indices(np.arange(min(len(archive), 1)))[0]
+            )
+
+        if not sample:
+            return np.empty((0, 0, 0, 1), dtype=np.float32), None, None
+
+        images = np.empty(
+            (len(indices),) + sample[0].shape + (1,), dtype=sample[0].dtype
+        )
+
+        for position, img in zip(order, gathered):
+            images[position, :, :, 0] = img
+
+        if "scale" not in metadata:
+            return images, None, None
+
+        scale = np.empty(len(indices), dtype=np.float32)
+        offset = np.empty(len(indices), dtype=np.float32)
+        scale[order] = metadata["scale"]
+        offset[order] = metadata["offset"]
+
+        return images, scale, offset
+
+    if f"{split}_scale" in data:
+        return data[f"{split}_imgs"], data[f"{split}_scale"], data[f"{split}_offset"]
+
+    return data[f"{split}_imgs"], None, None
+
+
+def load_images(data, split: str) -> np.ndarray:
+    """
+
+    Reads the images of one split of a selected dataset as float32, undoing
+    quantization. For index output, the images are gathered from the preprocessed
+    archive. For TFRecord output, the shards of the split are read in order into memory,
+    use split_dataset to stream them instead.
+
+    :param data: output of SelectDatasetTask opened with load_selection
+    :param split: "train", "valid" or "test"
+    :return: array of images
+    """
+
+    if "records" in data:
+        spec = read_spec(str(data["records"]))
+        images = np.empty(
+            (spec["n_images"][split],) + tuple(spec["image_shape"]), dtype=np.float32
+        )
+
+        for i, (img, _) in enumerate(
+            records_dataset(str(data["records"]), split).as_numpy_iterator()
+        ):
+            images[i] = img
+
+        return images
+
+    images, scale, offset = load_stored_images(data, split)
+    # float32 images stay memory-mapped when loaded with load_selection
+    images = np.asarray(images, dtype=np.float32)
+
+    if scale is not None:
+        # broadcast the per-image scale and offset over the image dimensions
+        shape = (-1,) + (1,) * (images.ndim - 1)
+        images = images * scale.reshape(shape) + offset.reshape(shape)
+
+    return images
+
+
+def split_dataset(
+    data, split: str, interleave: bool = False, seed: int = None
+) -> tf.data.Dataset:
+    """
 
+    Streams one split of a selected dataset as (image, label) pairs of float32 images.
+    The images are held in their storage precision and converted to float32 one at a
+    time in a tf.data map, so a quantized split takes a fraction of the memory of
+    load_images.
+
+    :param data: output of SelectDatasetTask opened with load_selection
+    :param split: "train", "valid" or "test"
+    :param interleave: for TFRecord output, read the shards in parallel in shuffled
+    order, see records_dataset
+    :param seed: seed of the shard order when interleaving
+    :return: tf.data.Dataset
+    """
+
+    if "records" in data:
+        return records_dataset(
+            str(data["records"]), split, interleave=interleave, seed=seed
+        )
 
-class SelectDatasetTask(luigi.Task):
+    images, scale, offset = load_stored_images(data, split)
+    labels = np.asarray(data[f"{split}_labels"])
+
+    if scale is None:
+        return tf.data.Dataset.from_tensor_slices((images, labels)).map(
+            lambda img, label: (tf.cast(img, tf.float32), label),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        )
+
+    return tf.data.Dataset.from_tensor_slices((images, scale, offset, labels)).map(
+        lambda img, img_scale, img_offset, label: (
+            tf.cast(img, tf.float32) * img_scale + img_offset,
+            label,
+        ),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    )
+
+
+class SelectDatasetTask(PreprocessedImagesMixin, luigi.Task):
     """
     Selecting classes from larger dataset to produce a smaller archive for training.
     Assigns data to the train/validation/test sets.
@@ -33,16 +288,194 @@ class SelectDatasetTask(luigi.Task):
         default=False
     )  # perform ZCA whitening on whole dataset
     epsilon = luigi.FloatParameter(default=0.1)
+    # "selection" fits the whitening on the selected images, "archive" on every image of
+    # the preprocessed archive, shared by all selections from it, see FitWhiteningTask
+    whiten_source = luigi.ChoiceParameter(
+        choices=["selection", "archive"], default="selection"
+    )
+    # number of images whitened at once, bounding the memory used on top of the dataset
+    whiten_batch_size = luigi.IntParameter(default=1024, significant=False)
+    # keep one image per distinct pixel content, so identical crops can't end up in both
+    # train and test
+    collapse_duplicates = luigi.BoolParameter(default=False)
+    # layout of the intermediate HDF5 archives, the selection itself does not depend on
+    # it.
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups", significant=False)
+    # preprocess in a single pass without intermediate archives, see ProcessImageTask
+    fused = luigi.BoolParameter(default=False, significant=False)
+    # preprocess while reading the original archive, without writing any intermediate
+    # archive
+    lazy = luigi.BoolParameter(default=False, significant=False)
+    # read the images from per-label shards written once per preprocessing, see
+    # LabelShardsTask
+    label_shards = luigi.BoolParameter(default=False, significant=False)
+    # precision of the stored images, in the intermediate archives and the output. See
+    # archive.quantize
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # "npz" stores the selected images, "npy" stores them uncompressed in a folder of
+    # memory-mappable NPY files, "index" only stores their indices into the preprocessed
+    # archive, and "tfrecord" stores them in a folder of TFRecord shards per split along
+    # with their labels and uuids
+    output_format = luigi.ChoiceParameter(
+        choices=["npz", "npy", "index", "tfrecord"], default="npz"
+    )
+    # number of TFRecord shards per split
+    n_shards = luigi.IntParameter(default=16, significant=False)
+    # if set, the OTHER class is a sample of at most this many images, stratified by
+    # sign
+    max_other = luigi.IntParameter(default=0)
 
     def requires(self):
         """
 
-        :return: StandardizeImageSizeTask
+        :return: dict with the StandardizeImageSizeTask (or OchreToHD5Task when
+        preprocessing lazily) as "images",
+            the FitWhiteningTask as "whitening" if whitening with a transform fitted on
+            the archive and the LabelShardsTask as "shards" if reading shards
         """
 
-        return StandardizeImageSizeTask(
-            self.imgfolder, self.hdffolder, self.target_size, self.sigma, self.threshold
-        )
+        # a lazy selection processes the images of the original archive itself
+        requirements = {"images": self.preprocessed_requirement()}
+
+        if self.whiten and self.whiten_source == "archive":
+            requirements["whitening"] = FitWhiteningTask(
+                imgfolder=self.imgfolder,
+                hdffolder=self.hdffolder,
+                target_size=self.target_size,
+                sigma=self.sigma,
+                threshold=self.threshold,
+                epsilon=self.epsilon,
+                precision=self.precision,
+                layout=self.layout,
+                fused=self.fused,
+                lazy=self.lazy,
+                batch_size=self.whiten_batch_size,
+            )
+
+        if self.label_shards:
+            requirements["shards"] = LabelShardsTask(
+                imgfolder=self.imgfolder,
+                hdffolder=self.hdffolder,
+                target_size=self.target_size,
+                sigma=self.sigma,
+                threshold=self.threshold,
+                precision=self.precision,
+                layout=self.layout,
+                fused=self.fused,
+                lazy=self.lazy,
+            )
+
+        return requirements
+
+    def _sample_other(self, data_archive):
+        """
+
+        Selects the rows of the labels grouped as OTHER. With max_other, draws a sample
+        stratified by label, with the number of images of each label proportional to its
+        size.
+
+        :param data_archive: archive reader
+        :return: dict mapping labels to sorted arrays of selected rows
+        """
+
+        other_rows = {
+            label: data_archive.label_rows[label]
+            for label in data_archive.labels()
+            if label not in self.keep_categories
+        }
+        n_other = sum(len(rows) for rows in other_rows.values())
+
+        if not self.max_other or n_other <= self.max_other:
+            return other_rows
+
+        # the label sizes are known from the archive, so each label gets a fixed quota.
+        # rounding down, then handing out the remaining images by largest remainder
+        exact = {
+            label: self.max_other * len(rows) / n_other
+            for label, rows in other_rows.items()
+        }
+        quotas = {label: int(quota) for label, quota in exact.items()}
+
+        for label in sorted(exact, key=lambda label: quotas[label] - exact[label])[
+            : self.max_other - sum(quotas.values())
+        ]:
+            quotas[label] += 1
+
+        return {
+            label: np.sort(np.random.choice(rows, quotas[label], replace=False))
+            for label, rows in other_rows.items()
+            if quotas[label] > 0
+        }
+
+    def _content_hashes(self, data_archive, rows, images=None):
+        """
+
+        Content hashes of the selected rows of a label, only computed when collapsing
+        duplicates.
+
+        :param data_archive: archive reader
+        :param rows: array of selected rows
+        :param images: the images of the rows if already read, to hash them if the
+        archive has no content hashes
+        :return: list of content hashes, or of None if not collapsing duplicates
+        """
+
+        if not self.collapse_duplicates:
+            return [None] * len(rows)
+
+        if "content_hash" in data_archive.metadata:
+            return [data_archive.metadata["content_hash"][i] for i in rows]
+
+        if images is None:
+            images = data_archive.read_indices(rows)[0]
+
+        return [image_hash(img) for img in images]
+
+    def _unique_positions(self, content_hashes, seen):
+        """
+
+        Positions of the images of a label to select, leaving out images whose pixel
+        content was already selected if collapse_duplicates is set.
+
+        :param content_hashes: content hash of each image of the label
+        :param seen: set of content hashes selected so far, updated in place
+        :return: list of positions within the label
+        """
+
+        if not self.collapse_duplicates:
+            return list(range(len(content_hashes)))
+
+        positions = []
+
+        for position, content_hash in enumerate(content_hashes):
+            if content_hash not in seen:
+                seen.add(content_hash)
+                positions.append(position)
+
+        return positions
+
+    def _split(self, n_images):
+        """
+
+        Splits shuffled data into train, valid and test sets, with the set sizes of
+        sklearn's train_test_split.
+
+        :param n_images: number of selected images
+        :return: dict mapping "train", "valid" and "test" to slices of the shuffled data
+        """
+
+        fracs = np.array(self.fractions)
+
+        # rounding the held out sets up
+        n_test = int(np.ceil(fracs[2] * n_images))
+        valid_split = fracs[1] / (fracs[0] + fracs[1])
+        n_valid = int(np.ceil(valid_split * (n_images - n_test)))
+
+        return {
+            "train": slice(n_test + n_valid, n_images),
+            "valid": slice(n_test, n_test + n_valid),
+            "test": slice(0, n_test),
+        }
 
     def run(self):
         """
@@ -57,106 +490,186 @@ class SelectDatasetTask(luigi.Task):
                 f"Invalid split {self.fractions} passed to --fractions argument. Fractions should add up to 1."
             )
 
-        # loads all data into memory.
-        # TODO: investigate streaming directly from HDF5 dataset
-
-        data_archive = h5py.File(self.input().path, "r")
-
-        # TODO: find total array dimensions from hdf archive
-
-        images_lst = []
-        labels_lst = []
+        if self.output_format == "index" and (self.whiten or self.lazy):
+            raise ValueError(
+                "Index output points into the preprocessed archive, so it can't be "
+                "combined with --whiten or --lazy."
+            )
 
-        for label in tqdm(self.keep_categories, desc="Selecting Labels"):
-            all_label_imgs = [
-                np.array(data_archive[label][img]) for img in data_archive[label].keys()
-            ]
+        data_archive = self.open_preprocessed(self.input()["images"].path)
 
-            images_lst.extend(all_label_imgs)
+        # only the metadata is taken from the archive, the pixels of the selected labels
+        # come from their shards
+        if self.label_shards:
+            data_archive = LabelShardsReader(self.input()["shards"].path, data_archive)
 
-            labels_lst.extend([label for img in all_label_imgs])
+        # archive label, class name and the rows selected from the label
+        selected = [
+            (label, label, data_archive.label_rows[label])
+            for label in self.keep_categories
+        ]
 
-        # getting the rest. Slight code reuse but easier to debug.
+        # getting the rest as OTHER
         if self.rest_as_other:
-            other_labels = [
-                label
-                for label in data_archive.keys()
-                if label not in self.keep_categories
-            ]
+            selected.extend(
+                (label, "OTHER", rows)
+                for label, rows in self._sample_other(data_archive).items()
+            )
 
-            for label in tqdm(other_labels, desc="Getting OTHER labels"):
-                all_label_imgs = [
-                    np.array(data_archive[label][img])
-                    for img in data_archive[label].keys()
-                ]
+        labels_lst = []
+        uuids = []
+        seen = set()
+        # identifies the source images of the archive the indices point into
+        archive_stamp = data_archive.attrs.get("stamp", "")
+
+        if self.output_format == "index":
+            # only the metadata is needed, unless duplicates have to be found from the
+            # pixels
+            indices = []
+
+            for label, class_name, rows in tqdm(selected, desc="Selecting Labels"):
+                positions = self._unique_positions(
+                    self._content_hashes(data_archive, rows), seen
+                )
+                indices.extend(rows[positions])
+                labels_lst.extend([class_name] * len(positions))
+
+            data = np.array(indices, dtype=np.int64)
+        else:
+            # streams every selected label into a preallocated array, holding one label
+            # at a time besides it. the total number of images is known from the
+            # archive. Collapsing duplicates can only lower it.
+            # [n_images, img_dim, img_dim, n_channels] (n_channels) is 1 in this case
+            data = np.empty(
+                (
+                    sum(len(rows) for _, _, rows in selected),
+                    self.target_size,
+                    self.target_size,
+                    1,
+                ),
+                dtype=np.float32,
+            )
 
-                images_lst.extend(all_label_imgs)
+            for label, class_name, rows in tqdm(selected, desc="Selecting Labels"):
+                all_label_imgs, metadata = data_archive.read_indices(rows)
+                all_label_imgs = dequantize(all_label_imgs, metadata)
 
-                labels_lst.extend(["OTHER" for img in all_label_imgs])
+                for position in self._unique_positions(
+                    self._content_hashes(data_archive, rows, all_label_imgs), seen
+                ):
+                    data[len(labels_lst), :, :, 0] = all_label_imgs[position]
+                    labels_lst.append(class_name)
+                    uuids.append(metadata["image_uuid"][position])
+
+            data = data[: len(labels_lst)]
 
         data_archive.close()
+
         # create categorical labels
         enc = LabelEncoder()
         categorical_labels = enc.fit_transform(labels_lst)
 
-        # [n_images, img_dim, img_dim, n_channels] (n_channels) is 1 in this case
-        images = np.expand_dims(np.stack(images_lst, axis=0), axis=-1)
+        arrays = {"classes": enc.classes_}
 
-        # perform ZCA whitening on entire dataset if specified
+        # perform ZCA whitening in place and batch-wise
         if self.whiten:
-            datagen = ImageDataGenerator(zca_whitening=True, zca_epsilon=self.epsilon)
-            datagen.fit(images)
-            # get everything back out
-
-            images, categorical_labels = datagen.flow(
-                images, y=categorical_labels, batch_size=images.shape[0]
-            ).next()
-
-        fracs = np.array(self.fractions)
-
-        # train/test split
-        train_imgs, test_imgs, train_labels, test_labels = train_test_split(
-            images, categorical_labels, test_size=fracs[2]
-        )
-
-        # split again for validation
-
-        valid_split = fracs[1] / (fracs[0] + fracs[1])
-
-        train_imgs, valid_imgs, train_labels, valid_labels = train_test_split(
-            train_imgs, train_labels, test_size=valid_split
-        )
-
-        # repeat train and test labels
-
-        np.savez_compressed(
-            self.output().path,
-            train_imgs=train_imgs,
-            test_imgs=test_imgs,
-            valid_imgs=valid_imgs,
-            train_labels=train_labels,
-            test_labels=test_labels,
-            valid_labels=valid_labels,
-            classes=enc.classes_,
-        )
+            if self.whiten_source == "archive":
+                whitening = ZCAWhitening.load(self.input()["whitening"].path)
+            else:
+                whitening = ZCAWhitening(self.epsilon)
+
+                for start in range(0, len(data), self.whiten_batch_size):
+                    whitening.partial_fit(data[start : start + self.whiten_batch_size])
+
+                whitening.fit()
+
+            whitening.transform_inplace(data, self.whiten_batch_size)
+
+            # kept with the dataset, to whiten new images the same way
+            arrays["zca_mean"] = np.array(whitening.mean, dtype=np.float32)
+            arrays["zca_components"] = whitening.components
+
+        # shuffling data and labels in place with the same permutation, so the splits
+        # are views, not copies
+        seed = np.random.randint(2 ** 31)
+        np.random.RandomState(seed).shuffle(data)
+        np.random.RandomState(seed).shuffle(categorical_labels)
+        uuids = np.array(uuids)
+        np.random.RandomState(seed).shuffle(uuids)
+
+        for split, rows in self._split(len(data)).items():
+            arrays[f"{split}_labels"] = categorical_labels[rows]
+
+            if self.output_format == "tfrecord":
+                arrays[f"{split}_uuids"] = uuids[rows]
+
+            if self.output_format == "index":
+                arrays[f"{split}_indices"] = data[rows]
+            else:
+                arrays.update(quantize_split(split, data[rows], self.precision))
+
+        if self.output_format == "index":
+            arrays["archive"] = np.array(os.path.abspath(self.input()["images"].path))
+            arrays["archive_stamp"] = np.array(archive_stamp)
+
+        if self.output_format == "npy":
+            with self.output().temporary_path() as temp_folder:
+                os.makedirs(temp_folder)
+
+                for name, array in arrays.items():
+                    np.save(os.path.join(temp_folder, f"{name}.npy"), array)
+        elif self.output_format == "tfrecord":
+            with self.output().temporary_path() as temp_folder:
+                os.makedirs(temp_folder)
+
+                n_images = {}
+
+                for split in ["train", "valid", "test"]:
+                    write_records(temp_folder, split, arrays, self.n_shards)
+                    n_images[split] = len(arrays[f"{split}_labels"])
+                    # the labels are small, and let load_selection open the folder like
+                    # the others
+                    np.save(
+                        os.path.join(temp_folder, f"{split}_labels.npy"),
+                        arrays[f"{split}_labels"],
+                    )
+
+                np.save(os.path.join(temp_folder, "classes.npy"), arrays["classes"])
+                write_spec(temp_folder, data.shape[1:], self.precision, n_images)
+        else:
+            np.savez_compressed(self.output().path, **arrays)
 
     def output(self):
         """
 
-        LocalTarget with path of the output NPZ archive.
+        LocalTarget with path of the output NPZ archive, or of the folder of NPY files
+        or TFRecord shards.
 
         :return: luigi.LocalTarget
         """
 
         return luigi.LocalTarget(
-            "{}/{}_{}_{}_{}{}{}{}.npz".format(
+            "{}/{}_{}_{}_{}{}{}{}{}{}{}{}".format(
                 self.hdffolder,
-                os.path.basename(self.imgfolder),
+                dataset_name(self.imgfolder),
                 self.target_size,
                 "_".join([str(cat) for cat in self.keep_categories]),
                 self.sigma,
-                "_OTHER" if self.rest_as_other else "",
-                f"_whitened_{self.epsilon}" if self.whiten else "",
+                f"_OTHER{self.max_other or ''}" if self.rest_as_other else "",
+                (
+                    "_whitened{}_{}".format(
+                        "_archive" if self.whiten_source == "archive" else "",
+                        self.epsilon,
+                    )
+                    if self.whiten
+                    else ""
+                ),
                 "threshed" if self.threshold else "",
+                "_dedup" if self.collapse_duplicates else "",
+                f"_{self.precision}" if self.precision != "float32" else "",
+                "_index" if self.output_format == "index" else "",
+                {"npy": "_npy", "tfrecord": "_tfrecord"}.get(
+                    self.output_format, ".npz"
+                ),
             )
         )
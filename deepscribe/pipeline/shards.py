@@ -0,0 +1,293 @@
+# per-label shards of a preprocessed archive
+#
+# LabelShardsTask writes the images of every label of a preprocessed archive to their
+# own NPY file, once per preprocessing configuration. Selections of different category
+# subsets then read only the shards of the labels they need, memory-mapped, instead of
+# scanning the archive again. LabelShardsReader serves the shards through the archive
+# reader interface, with the metadata of the archive.
+#
+# Shards hold the images in the storage precision of the archive, with the scale and
+# offset of uint8 images next to them, whether they were written from the archive or
+# preprocessed lazily. The reader takes the scale and offset from the shards, so the
+# images are dequantized the same way in both cases.
+#
+# The shards record the stamp of the archive they were written from. Incremental runs
+# rewrite the archive in place, so the shards are written again when the stamps differ,
+# and the reader refuses stale shards.
+
+import json
+import os
+import shutil
+import luigi
+import numpy as np
+from tqdm import tqdm
+from typing import Dict, List, Tuple
+from deepscribe.pipeline.aggregation import dataset_name
+from deepscribe.pipeline.archive import (
+    ArchiveReader,
+    open_archive,
+    quantize,
+    LAYOUTS,
+    PRECISIONS,
+)
+from deepscribe.pipeline.images import PreprocessedImagesMixin
+
+
+SPEC_FILE = "shards.json"
+
+
+def read_stamp(folder: str) -> str:
+    """
+
+    :param folder: folder of label shards
+    :return: stamp of the archive the shards were written from, empty if it had none, or
+    None for shards written without one
+    """
+    path = os.path.join(folder, SPEC_FILE)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as inf:
+        return json.load(inf)["stamp"]
+
+
+def shard_path(folder: str, label: str) -> str:
+    """
+
+    :param folder: folder of label shards
+    :param label: label in the archive
+    :return: path of the shard of the label, named by the hex encoding of the label
+    """
+    return "{}/{}.npy".format(folder, label.encode("utf-8").hex())
+
+
+def quantization_path(folder: str, label: str) -> str:
+    """
+
+    :param folder: folder of label shards
+    :param label: label in the archive
+    :return: path of the scale and offset of the uint8 images of the label,
+    [n_images, 2]
+    """
+    return "{}/{}_quantization.npy".format(folder, label.encode("utf-8").hex())
+
+
+class LabelShardsReader(ArchiveReader):
+    """
+    Reads the images of a preprocessed archive from its label shards, memory-mapping
+    each shard on first access. Offers the same interface as the archive readers, with
+    the metadata and image indices of the archive.
+
+    """
+
+    def __init__(self, folder: str, index: ArchiveReader):
+        """
+
+        :param folder: output folder of LabelShardsTask
+        :param index: reader of the archive the shards were written from, only used for
+        its metadata
+        """
+        if read_stamp(folder) != index.attrs.get("stamp", ""):
+            raise ValueError(
+                f"The label shards in {folder} were written from other source images "
+                f"than the archive."
+            )
+
+        self.folder = folder
+        self.index = index
+        self.archive = index.archive
+        self.metadata = index.metadata
+        self.image_labels = index.image_labels
+        self.label_rows = index.label_rows
+
+        # position of each image within the shard of its label
+        self.positions = np.empty(len(self.image_labels), dtype=np.int64)
+
+        for rows in self.label_rows.values():
+            self.positions[rows] = np.arange(len(rows))
+
+        self.shards = {}
+        self.quantization = {}
+
+    def shard(self, label: str) -> np.ndarray:
+        """
+
+        :param label: label in the archive
+        :return: memory-mapped array of the images of the label, [n_images, ...]
+        """
+        if label not in self.shards:
+            self.shards[label] = np.load(shard_path(self.folder, label), mmap_mode="r")
+
+        return self.shards[label]
+
+    def label_quantization(self, label: str) -> np.ndarray:
+        """
+
+        :param label: label in the archive
+        :return: array of the scale and offset of each image of the label,
+        [n_images, 2], or None unless uint8
+        """
+        if label not in self.quantization:
+            path = quantization_path(self.folder, label)
+            self.quantization[label] = np.load(path) if os.path.exists(path) else None
+
+        return self.quantization[label]
+
+    def read_indices(self, indices) -> Tuple[List[np.ndarray], Dict[str, list]]:
+        """
+
+        Reads the images with the given indices, in the given order. The scale and
+        offset in the metadata are those the shards were stored with.
+
+        :param indices: array of image indices
+        :return: list of images, dict mapping metadata keys (including "name") to lists
+        of values
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        images, metadata = super().read_indices(indices)
+        metadata.pop("scale", None)
+        metadata.pop("offset", None)
+
+        quantization = [
+            self.label_quantization(self.image_labels[row]) for row in indices
+        ]
+
+        if any(values is not None for values in quantization):
+            scale_offset = [
+                values[self.positions[row]]
+                for values, row in zip(quantization, indices)
+            ]
+            metadata["scale"] = [float(scale) for scale, _ in scale_offset]
+            metadata["offset"] = [float(offset) for _, offset in scale_offset]
+
+        return images, metadata
+
+    def _read_rows(self, indices: np.ndarray) -> List[np.ndarray]:
+        """
+
+        Reads the images with the given indices from the shards of their labels.
+
+        :param indices: array of image indices
+        :return: list of images
+        """
+        images = [None] * len(indices)
+        by_label = {}
+
+        for i, row in enumerate(indices):
+            by_label.setdefault(self.image_labels[row], []).append(i)
+
+        for label, order in by_label.items():
+            for i, img in zip(order, self.shard(label)[self.positions[indices[order]]]):
+                images[i] = img
+
+        return images
+
+    def close(self):
+        self.index.close()
+        self.shards.clear()
+        self.quantization.clear()
+
+
+class LabelShardsTask(PreprocessedImagesMixin, luigi.Task):
+    """
+    Splits a preprocessed archive into one NPY file of images per label, stored as in
+    the archive. Images preprocessed lazily are converted to the storage precision
+    first.
+
+    """
+
+    imgfolder = luigi.Parameter()
+    hdffolder = luigi.Parameter()
+    target_size = luigi.IntParameter()  # standardizing to square images
+    sigma = luigi.FloatParameter(default=0.5)
+    threshold = luigi.BoolParameter(default=False)
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # options of the preprocessing, see SelectDatasetTask
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups", significant=False)
+    fused = luigi.BoolParameter(default=False, significant=False)
+    lazy = luigi.BoolParameter(default=False, significant=False)
+
+    def requires(self):
+        """
+
+        :return: StandardizeImageSizeTask, or OchreToHD5Task when preprocessing lazily
+        """
+
+        return self.preprocessed_requirement()
+
+    def complete(self):
+        """
+
+        The shards are only complete if they were written from the current archive,
+        compared by stamp.
+
+        :return: bool
+        """
+
+        if not super().complete():
+            return False
+
+        # an upstream change has to propagate, even though the shards exist
+        if not all(task.complete() for task in luigi.task.flatten(self.requires())):
+            return False
+
+        with open_archive(self.input().path) as archive:
+            return read_stamp(self.output().path) == archive.attrs.get("stamp", "")
+
+    def run(self):
+        """
+
+        Writes the images of each label to its shard, one label at a time, replacing
+        stale shards.
+
+        :return:
+        """
+
+        if self.output().exists():
+            shutil.rmtree(self.output().path)
+
+        archive = self.open_preprocessed(self.input().path)
+
+        with archive, self.output().temporary_path() as temp_folder:
+            os.makedirs(temp_folder)
+
+            for label in tqdm(archive.labels(), desc="Writing label shards"):
+                images, metadata = archive.read_label(label)
+
+                # lazily processed images are float32, the archive holds them in the
+                # storage precision
+                if self.lazy:
+                    images, metadata = quantize(images, metadata, self.precision)
+
+                np.save(shard_path(temp_folder, label), np.stack(images))
+
+                if "scale" in metadata:
+                    np.save(
+                        quantization_path(temp_folder, label),
+                        np.array(
+                            [metadata["scale"], metadata["offset"]], dtype=np.float32
+                        ).T,
+                    )
+
+            with open(os.path.join(temp_folder, SPEC_FILE), "w") as outf:
+                json.dump({"stamp": archive.attrs.get("stamp", "")}, outf)
+
+    def output(self):
+        """
+
+        Location of the folder of label shards.
+
+        :return: luigi.LocalTarget
+        """
+
+        return luigi.LocalTarget(
+            "{}/{}_{}_{}{}{}_shards".format(
+                self.hdffolder,
+                dataset_name(self.imgfolder),
+                self.target_size,
+                self.sigma,
+                "_threshed" if self.threshold else "",
+                f"_{self.precision}" if self.precision != "float32" else "",
+            )
+        )
@@ -2,10 +2,18 @@
 #
 
 import luigi
-from deepscribe.pipeline.selection import SelectDatasetTask
+from deepscribe.pipeline.selection import (
+    SelectDatasetTask,
+    load_selection,
+    load_images,
+    split_dataset,
+    selection_name,
+    selection_stamp,
+)
+from deepscribe.pipeline.archive import PRECISIONS
 from deepscribe.models.baselines import cnn_classifier_2conv, cnn_classifier_4conv
 from deepscribe.models.cnn import VGG16, VGG19, ResNet50, ResNet50V2
-import numpy as np
+from deepscribe.models.datasets import uses_tf_data
 import json
 from pathlib import Path
 from abc import ABC
@@ -42,6 +50,17 @@ class TrainModelFromDefinitionTask(luigi.Task, ABC):
     )  # set the remaining as "other" - not recommended for small keep_category lengths
     whiten = luigi.BoolParameter(default=False)
     epsilon = luigi.FloatParameter(default=0.1)
+    # data the whitening is fitted on, see SelectDatasetTask
+    whiten_source = luigi.ChoiceParameter(
+        choices=["selection", "archive"], default="selection"
+    )
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # format of the selected dataset, see SelectDatasetTask
+    output_format = luigi.ChoiceParameter(
+        choices=["npz", "npy", "index", "tfrecord"], default="npz"
+    )
+    # size of the OTHER sample, see SelectDatasetTask
+    max_other = luigi.IntParameter(default=0)
 
     def requires(self):
         """
@@ -59,6 +78,10 @@ class TrainModelFromDefinitionTask(luigi.Task, ABC):
             self.rest_as_other,
             self.whiten,
             self.epsilon,
+            whiten_source=self.whiten_source,
+            precision=self.precision,
+            output_format=self.output_format,
+            max_other=self.max_other,
         )
 
     def load_def(self):
@@ -114,8 +137,41 @@ class TrainKerasModelFromDefinitionTask(TrainModelFromDefinitionTask):
 
         model_params["SLURM_RUN"] = os.environ.get("SLURM_JOB_ID", "NONE")
 
+        # features of frozen base models are cached per dataset, see TransferCNN
+        model_params["feature_cache"] = "{}/features/{}".format(
+            self.hdffolder, selection_name(self.input().path)
+        )
+        model_params["feature_stamp"] = selection_stamp(self.input().path)
+
         return model_params
 
+    def load_split(self, data, split: str, model_params: dict):
+        """
+
+        Loads the images of one split. With the tf.data input pipeline, the split is
+        streamed instead, converting quantized images to float32 one at a time and
+        interleaving the shards of a TFRecord training set. The generator pipeline
+        copies its input to float32 as a whole, so the split is loaded as float32 for
+        it.
+
+        :param data: output of SelectDatasetTask opened with load_selection
+        :param split: "train", "valid" or "test"
+        :param model_params: dict
+        :return: array of images, or tf.data.Dataset of (image, label) pairs
+        """
+
+        if uses_tf_data(model_params):
+            return split_dataset(
+                data,
+                split,
+                # cached features have to be computed in the order of the labels
+                interleave=split == "train"
+                and not model_params.get("cache_features", False),
+                seed=model_params.get("seed", 0),
+            )
+
+        return load_images(data, split)
+
     def run_training(self, model_params: dict):
         """
         Selects model class from params dictionary and runs training.
@@ -124,35 +180,29 @@ class TrainKerasModelFromDefinitionTask(TrainModelFromDefinitionTask):
         :return: None
         """
 
-        data = np.load(self.input().path)
+        data = load_selection(self.input().path)
 
         if "conv4_kernels" in model_params:
             _, model = cnn_classifier_4conv(
-                data["train_imgs"],
+                load_images(data, "train"),
                 data["train_labels"],  # using sparse categorical cross-entropy
-                data["valid_imgs"],
+                load_images(data, "valid"),
                 data["valid_labels"],
                 model_params,
             )
         elif "architecture" in model_params and model_params["architecture"] == "vgg16":
-
-            # TODO: build image dimension handling into the model object?
-
             _, model = VGG16()(
-                np.repeat(data["train_imgs"], 3, axis=3),  # vgg16 expects RGB
+                self.load_split(data, "train", model_params),
                 data["train_labels"],  # using sparse categorical cross-entropy
-                np.repeat(data["valid_imgs"], 3, axis=3),
+                self.load_split(data, "valid", model_params),
                 data["valid_labels"],
                 model_params,
             )
         elif "architecture" in model_params and model_params["architecture"] == "vgg19":
-
-            # TODO: build image dimension handling into the model object?
-
             _, model = VGG19()(
-                np.repeat(data["train_imgs"], 3, axis=3),  # vgg19 expects RGB
+                self.load_split(data, "train", model_params),
                 data["train_labels"],  # using sparse categorical cross-entropy
-                np.repeat(data["valid_imgs"], 3, axis=3),
+                self.load_split(data, "valid", model_params),
                 data["valid_labels"],
                 model_params,
             )
@@ -162,9 +212,9 @@ class TrainKerasModelFromDefinitionTask(TrainModelFromDefinitionTask):
             and model_params["architecture"] == "resnet50"
         ):
             _, model = ResNet50()(
-                np.repeat(data["train_imgs"], 3, axis=3),  # resnet expects RGB
+                self.load_split(data, "train", model_params),
                 data["train_labels"],  # using sparse categorical cross-entropy
-                np.repeat(data["valid_imgs"], 3, axis=3),
+                self.load_split(data, "valid", model_params),
                 data["valid_labels"],
                 model_params,
             )
@@ -174,18 +224,18 @@ class TrainKerasModelFromDefinitionTask(TrainModelFromDefinitionTask):
             and model_params["architecture"] == "resnet50v2"
         ):
             _, model = ResNet50V2()(
-                np.repeat(data["train_imgs"], 3, axis=3),  # resnet expects RGB
+                self.load_split(data, "train", model_params),
                 data["train_labels"],  # using sparse categorical cross-entropy
-                np.repeat(data["valid_imgs"], 3, axis=3),
+                self.load_split(data, "valid", model_params),
                 data["valid_labels"],
                 model_params,
             )
 
         else:
             _, model = cnn_classifier_2conv(
-                data["train_imgs"],
+                self.load_split(data, "train", model_params),
                 data["train_labels"],  # using sparse categorical cross-entropy
-                data["valid_imgs"],
+                self.load_split(data, "valid", model_params),
                 data["valid_labels"],
                 model_params,
             )
@@ -202,10 +252,10 @@ class TrainKerasModelFromDefinitionTask(TrainModelFromDefinitionTask):
         """
 
         p = Path(self.model_definition)
-        p_data = Path(self.input().path)
+        data_name = selection_name(self.input().path)
 
         return luigi.LocalTarget(
-            "{}/{}_{}/trained.h5".format(self.modelsfolder, p.stem, p_data.stem)
+            "{}/{}_{}/trained.h5".format(self.modelsfolder, p.stem, data_name)
         )
 
 
@@ -233,12 +283,12 @@ class RunTalosScanTask(TrainModelFromDefinitionTask):
         return talos_params
 
     def run_training(self, model_params: dict):
-        data = np.load(self.input().path)
+        data = load_selection(self.input().path)
 
         scan_object = talos.Scan(
-            data["train_imgs"],
+            load_images(data, "train"),
             data["train_labels"],
-            x_val=data["valid_imgs"],
+            x_val=load_images(data, "valid"),
             y_val=data["valid_labels"],
             model=cnn_classifier_2conv,
             params=model_params,
@@ -259,8 +309,8 @@ class RunTalosScanTask(TrainModelFromDefinitionTask):
         """
 
         p = Path(self.model_definition)
-        p_data = Path(self.input().path)
+        data_name = selection_name(self.input().path)
 
         return luigi.LocalTarget(
-            "{}/{}_{}/talos_scan.pkl".format(self.modelsfolder, p.stem, p_data.stem)
+            "{}/{}_{}/talos_scan.pkl".format(self.modelsfolder, p.stem, data_name)
         )
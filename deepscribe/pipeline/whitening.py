@@ -0,0 +1,219 @@
+# ZCA whitening of image datasets too large to hold in memory more than once
+#
+# Matches the whitening of keras' ImageDataGenerator(zca_whitening=True): the mean pixel
+# value is subtracted, then the flattened images are multiplied with U diag(1 / sqrt(S +
+# epsilon)) U^T, where U S U^T is the covariance of the centered images. The statistics
+# are accumulated over batches in a single pass, so only the D x D covariance is held in
+# memory besides the current batch.
+#
+# FitWhiteningTask fits the transform on a whole preprocessed archive and saves it, so
+# selections with --whiten-source archive and inference on the same source, size, sigma
+# and epsilon share it.
+
+import luigi
+import numpy as np
+from scipy import linalg
+from tqdm import tqdm
+from deepscribe.pipeline.aggregation import dataset_name
+from deepscribe.pipeline.archive import dequantize, LAYOUTS, PRECISIONS
+from deepscribe.pipeline.images import PreprocessedImagesMixin
+
+
+class ZCAWhitening:
+    """
+
+    Incrementally fitted ZCA whitening transform.
+
+    """
+
+    def __init__(self, epsilon: float = 1e-6):
+        self.epsilon = epsilon
+
+        # sufficient statistics, in float64
+        self.n_images = 0
+        self.pixel_sums = None  # sum of each pixel over the images
+        self.products = None  # sum of the outer products of the flattened images
+
+        self.mean = None
+        self.components = None
+
+    def partial_fit(self, images: np.ndarray):
+        """
+
+        Adds a batch of images to the statistics.
+
+        :param images: array of images, [n_images, ...]
+        :return: None
+        """
+        flat = images.reshape(len(images), -1).astype(np.float64)
+
+        if self.products is None:
+            self.pixel_sums = np.zeros(flat.shape[1])
+            self.products = np.zeros((flat.shape[1], flat.shape[1]))
+
+        self.n_images += len(flat)
+        self.pixel_sums += flat.sum(axis=0)
+        self.products += flat.T @ flat
+
+    def fit(self):
+        """
+
+        Computes the mean and the whitening matrix from the accumulated statistics.
+
+        :return: self
+        """
+        if self.n_images == 0:
+            raise ValueError("No images to fit the whitening on.")
+
+        n_pixels = len(self.pixel_sums)
+        self.mean = self.pixel_sums.sum() / (self.n_images * n_pixels)
+
+        # covariance of the images centered on the scalar mean, expanded so it can be
+        # accumulated in one pass
+        sigma = (
+            self.products
+            - self.mean
+            * (self.pixel_sums[:, np.newaxis] + self.pixel_sums[np.newaxis, :])
+        ) / self.n_images + self.mean ** 2
+
+        eigenvalues, eigenvectors = linalg.eigh(sigma)
+        # rounding can push the eigenvalues of a singular covariance just below zero
+        eigenvalues = np.clip(eigenvalues, 0, None)
+
+        self.components = (
+            (eigenvectors / np.sqrt(eigenvalues + self.epsilon)) @ eigenvectors.T
+        ).astype(np.float32)
+
+        return self
+
+    def transform(self, images: np.ndarray) -> np.ndarray:
+        """
+
+        Whitens a batch of images.
+
+        :param images: array of images, [n_images, ...]
+        :return: array of whitened float32 images, same shape
+        """
+        flat = images.reshape(len(images), -1).astype(np.float32) - np.float32(
+            self.mean
+        )
+
+        return (flat @ self.components).reshape(images.shape)
+
+    def transform_inplace(self, images: np.ndarray, batch_size: int = 1024):
+        """
+
+        Whitens a float32 array of images in place, one batch at a time.
+
+        :param images: array of float32 images, [n_images, ...]
+        :param batch_size: number of images whitened at once
+        :return: None
+        """
+        for start in range(0, len(images), batch_size):
+            images[start : start + batch_size] = self.transform(
+                images[start : start + batch_size]
+            )
+
+    def save(self, path: str):
+        """
+
+        Saves the fitted transform as an NPZ archive.
+
+        :param path: path of the archive, written as given even without the .npz
+        extension
+        :return: None
+        """
+        with open(path, "wb") as outf:
+            np.savez(
+                outf, mean=self.mean, components=self.components, epsilon=self.epsilon
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "ZCAWhitening":
+        """
+
+        Loads a transform saved with save().
+
+        :param path: path of the archive
+        :return: ZCAWhitening
+        """
+        with np.load(path) as saved:
+            whitening = cls(float(saved["epsilon"]))
+            whitening.mean = float(saved["mean"])
+            whitening.components = saved["components"]
+
+        return whitening
+
+
+class FitWhiteningTask(PreprocessedImagesMixin, luigi.Task):
+    """
+    Fits a ZCA whitening transform on every image of a preprocessed archive and saves it
+    as an NPZ archive.
+
+    """
+
+    imgfolder = luigi.Parameter()
+    hdffolder = luigi.Parameter()
+    target_size = luigi.IntParameter()  # standardizing to square images
+    sigma = luigi.FloatParameter(default=0.5)
+    threshold = luigi.BoolParameter(default=False)
+    epsilon = luigi.FloatParameter(default=0.1)
+    precision = luigi.ChoiceParameter(choices=PRECISIONS, default="float32")
+    # options of the preprocessing, see SelectDatasetTask
+    layout = luigi.ChoiceParameter(choices=LAYOUTS, default="groups", significant=False)
+    fused = luigi.BoolParameter(default=False, significant=False)
+    lazy = luigi.BoolParameter(default=False, significant=False)
+    # number of images added to the statistics at once
+    batch_size = luigi.IntParameter(default=1024, significant=False)
+
+    def requires(self):
+        """
+
+        :return: StandardizeImageSizeTask, or OchreToHD5Task when preprocessing lazily
+        """
+
+        return self.preprocessed_requirement()
+
+    def run(self):
+        """
+
+        Streams the archive through ZCAWhitening and saves the fitted transform.
+
+        :return:
+        """
+
+        archive = self.open_preprocessed(self.input().path)
+        whitening = ZCAWhitening(self.epsilon)
+
+        with archive:
+            for label in tqdm(archive.labels(), desc="Fitting whitening"):
+                rows = archive.label_rows[label]
+
+                for start in range(0, len(rows), self.batch_size):
+                    images, metadata = archive.read_indices(
+                        rows[start : start + self.batch_size]
+                    )
+                    whitening.partial_fit(np.stack(dequantize(images, metadata)))
+
+        with self.output().temporary_path() as temp_path:
+            whitening.fit().save(temp_path)
+
+    def output(self):
+        """
+
+        Location of the saved transform.
+
+        :return: luigi.LocalTarget
+        """
+
+        return luigi.LocalTarget(
+            "{}/{}_{}_{}{}{}_zca_{}.npz".format(
+                self.hdffolder,
+                dataset_name(self.imgfolder),
+                self.target_size,
+                self.sigma,
+                "_threshed" if self.threshold else "",
+                f"_{self.precision}" if self.precision != "float32" else "",
+                self.epsilon,
+            )
+        )